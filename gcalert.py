@@ -7,6 +7,7 @@
 # Only 'popup' alarms will result in what's essentially a popup. This is a feature :)
 #
 # Requires: python-notify python-gdata python-dateutil notification-daemon
+# Optional: python-gobject, for snooze and dismiss buttons on the notifications
 #
 # Home: http://github.com/raas/gcalert
 #
@@ -31,8 +32,6 @@
 # TODO:
 # - warn for unsecure permissions of the password/secret file
 # - use some sort of proper logging with log levels etc
-# - options for selecting which calendars to alert (currently: all of them)
-# - snooze buttons; this requires a gtk.main() thread and that's not trivial
 # - testing (as in, unit testing), after having a main()
 # - multi-language support
 # - GUI and status bar icon
@@ -44,23 +43,35 @@ import time
 import urllib
 import thread
 import signal
+import heapq
+import itertools
+import select
+import fcntl
+import socket
+import Queue
+import json
+import re
+import fnmatch
+import bisect
+import zlib
+import BaseHTTPServer
+import random
+import errno
+import imp
+import threading
+import datetime
+from calendar import timegm
 
-# dependencies below come from separate packages, the rest (above) is in the
+# dependencies come from separate packages, the rest (above) is in the
 # standard library so those are expected to work :)
-try:
-    # google calendar stuff
-    import gdata.calendar.service 
-    import gdata.service
-    import gdata.calendar
-    # libnotify handler
-    import pynotify
-    # magical date parser and timezone handler
-    import dateutil.tz 
-    import dateutil.parser 
-except ImportError as e:
-    print "Dependency was not found! %s" % e
-    print "(Try: sudo apt-get install python-notify python-gdata python-dateutil notification-daemon)"
-    sys.exit(1)
+#
+# They are only checked for at startup, see check_dependencies(), and
+# imported where they are first needed, so that -h and --command don't wait
+# for them and alarms from the cache can go off before gdata is loaded:
+# - gdata: google calendar stuff, in get_calendar_service()
+# - pynotify: libnotify handler, and gobject (optional): main loop for the
+#   callbacks of notification buttons, in LibnotifyNotifier.init()
+# - dateutil: magical date parser and timezone handler, in parse_time()
 
 # -------------------------------------------------------------------------------------------
 
@@ -69,95 +80,269 @@ myversion = '2.0'
 # -------------------------------------------------------------------------------------------
 # default values for parameters
 
-secrets_file = os.path.join(os.environ["HOME"],".gcalert_secret")
-alarm_sleeptime = 30 # seconds between waking up to check alarm list
-query_sleeptime = 180 # seconds between querying Google 
+secrets_file = os.path.join(os.environ["HOME"],".gcalert_secret") # if no secrets_files are given
+secrets_files = [] # one for each account to watch
+cache_file = os.path.join(os.environ["HOME"],".gcalert_cache") # events are saved here between runs; '' to disable
+cache_max_age = 86400 # seconds; pending events from an older cache are not used
+alarm_sleeptime = 30 # unused: alarms go off when they are due (-a is accepted for compatibility)
+query_sleeptime = 600 # seconds between querying Google when no alarms are coming up
+query_min_sleeptime = 60 # seconds between querying Google at least, however close the next alarm is
 lookahead_days = 3 # look this many days in the future
 debug_flag = False
 quiet_flag = False
-login_retry_sleeptime = 300 # seconds between reconnects in case of errors
-threads_offset = 5 # this many seconds offset between the two threads' runs
+login_retry_sleeptime = 300 # seconds between reconnects in case of login errors, at first
+retry_max_sleeptime = 3600 # seconds between retries at most, however long the errors go on
+poll_jitter = 0.2 # sleep times vary this much (+-20%) so that many gcalerts don't poll in step
+fetch_workers = 4 # this many calendars are queried at the same time
+fetch_timeout = 60 # seconds to wait for Google to answer one query
+full_sync_sleeptime = 3600 # seconds between downloading all events; in between, only changes are asked for
+feed_page_size = 250 # events asked for in one request; bigger calendars come in several pages
+local_recurrence = False # get recurring events as their recurrence rules and work out the occurences here, instead of Google sending each
+recurrence_horizon = 86400 # seconds; with local_recurrence, GcEvents are made for the occurences starting this far ahead only
 strftime_string = '%Y-%m-%d  %H:%M' # in the event display
 icon = 'gtk-dialog-info' # icon to use in notifications
+notify_backend = 'libnotify' # how to show alarms: 'libnotify', 'stdout' or 'file:/some/file/or/fifo'
+notify_timeout = 10 # seconds to wait for a notification to be shown before retrying
+notify_retries = 3 # retry failed notifications this many times, waiting longer each time
+coalesce_sleeptime = 5 # alarms going off within this many seconds are shown as one notification
+engine = 'threads' # 'threads': alarms and syncing in threads of their own, 'loop': in one select() loop
+metrics_port = 0 # serve metrics on http://localhost:metrics_port/metrics; 0 to disable
+control_socket = os.path.join(os.environ["HOME"],".gcalert_control") # Unix socket to list, snooze and dismiss alarms through; '' to disable
+snooze_minutes = 5 # snoozed alarms go off again this many minutes later, unless told otherwise
+calendar_includes = [] # only calendars whose id or name matches one of these (* and ? allowed) are watched; empty: all of them
+calendar_excludes = [] # calendars whose id or name matches one of these are not watched, even if included
+title_include_re = None # if set, only events whose title matches this regex are alarmed
+title_exclude_re = None # if set, events whose title matches this regex are not alarmed
 
 # -------------------------------------------------------------------------------------------
 # end of user-changeable stuff here
 # -------------------------------------------------------------------------------------------
 
-events=[] # all events seen so far that are yet to start
-events_lock=thread.allocate_lock() # hold to access events[]
-alarmed_events = [] # events (occurences etc) already alarmed
-connected = False # google connection is disconnected
+class Metrics(object):
+    """
+    Counters, gauges and histograms about what gcalert is doing,
+    to be read in the Prometheus text format from text()
+
+    labels: tuple of (label name, value) pairs
+    """
+    buckets = (0.0001, 0.001, 0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300) # seconds, for histograms
+
+    def __init__(self):
+        self.lock = thread.allocate_lock() # hold to access the dicts below
+        self.types = {} # metric name -> 'counter', 'gauge' or 'histogram'
+        self.values = {} # (name, labels) -> value of counter or gauge
+        self.histograms = {} # (name, labels) -> [count in each bucket and above all..., sum]
+
+    def inc(self, name, value=1, labels=()):
+        """Add 'value' to a counter"""
+        self.lock.acquire()
+        self.types[name] = 'counter'
+        self.values[(name, labels)] = self.values.get((name, labels), 0) + value
+        self.lock.release()
+
+    def set(self, name, value, labels=()):
+        """Set a gauge to 'value'"""
+        self.lock.acquire()
+        self.types[name] = 'gauge'
+        self.values[(name, labels)] = value
+        self.lock.release()
+
+    def observe(self, name, value, labels=()):
+        """Count 'value' in a histogram"""
+        self.lock.acquire()
+        self.types[name] = 'histogram'
+        h = self.histograms.get((name, labels))
+        if h is None:
+            h = self.histograms[(name, labels)] = [0] * (len(self.buckets) + 2)
+        h[bisect.bisect_left(self.buckets, value)] += 1
+        h[-1] += value
+        self.lock.release()
+
+    def text(self):
+        """All metrics, in the Prometheus text exposition format"""
+        def label_string(labels):
+            if not labels:
+                return ''
+            return '{%s}' % ','.join([ '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for (k, v) in labels ])
+        self.lock.acquire()
+        lines = []
+        for name in sorted(self.types):
+            lines.append('# TYPE %s %s' % (name, self.types[name]))
+            for ((n, labels), value) in sorted(self.values.items()):
+                if n == name:
+                    lines.append('%s%s %s' % (name, label_string(labels), value))
+            for ((n, labels), h) in sorted(self.histograms.items()):
+                if n != name:
+                    continue
+                total = 0
+                for (le, count) in zip(self.buckets + ('+Inf',), h[:-1]):
+                    total += count
+                    lines.append('%s_bucket%s %d' % (name, label_string(labels + (('le', le),)), total))
+                lines.append('%s_sum%s %f' % (name, label_string(labels), h[-1]))
+                lines.append('%s_count%s %d' % (name, label_string(labels), total))
+        self.lock.release()
+        return '\n'.join(lines) + '\n'
+
+class TimedLock(object):
+    """A lock that keeps track of how long it is waited for and held, in metrics"""
+    def __init__(self, name):
+        self.lock = thread.allocate_lock()
+        self.name = name
+        self.acquired_at = 0
+
+    def acquire(self):
+        t = time.time()
+        self.lock.acquire()
+        self.acquired_at = time.time()
+        metrics.observe('gcalert_lock_wait_seconds', self.acquired_at - t, (('lock', self.name),))
+
+    def release(self):
+        held = time.time() - self.acquired_at
+        self.lock.release()
+        metrics.observe('gcalert_lock_hold_seconds', held, (('lock', self.name),))
+
+class Clock(object):
+    """
+    The time as far as events, alarms and syncing are concerned; a
+    simulation can put a virtual clock in its place (see gcalert_sim.py)
+    """
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def select(self, fds, seconds):
+        """Wait 'seconds' (None: forever) for one of the file descriptors 'fds' to be readable; returns those that are"""
+        return select.select(fds, [], [], seconds)[0]
+
+metrics=Metrics()
+clock=Clock()
+accounts=[] # Account for each secrets file
+events_lock=TimedLock('events_lock') # hold to access alarm_queue[] and the events of the accounts
+alarm_queue=[] # heap of [alarm_time_unix, sequence, event, account]; event is None once cancelled
+alarm_sequence=itertools.count() # tie-breaker for alarms going off at the same second
+wakeup_pipe=os.pipe() # write here to make process_events_thread (or the EventLoop) look at alarm_queue[] again
+notification_queue=Queue.Queue() # (list of GcEvents alarmed together, their alarm ids), for notification_thread
+notifier=None # the backend in use, see make_notifier()
+shutdown_requested=False # set on SIGINT/SIGTERM; the main loop stops and saves the cache
+fetch_jobs=Queue.Queue() # (function, arguments, result queue) for the fetch_worker threads
+fetch_workers_lock=thread.allocate_lock() # hold to start fetch_worker threads
+fetch_workers_started=0 # number of fetch_worker threads running
+parsed_times={} # time string -> unix time, for the current query; recurring events share a lot
+pending_alarms={} # alarm_id() -> [account, event, unix time it's snoozed until or None], for alarms shown and not dismissed
+pending_expiry=[] # heap of (end time, alarm id) of pending_alarms{}; they are forgotten when the event is over
+ical_duration_re=re.compile(r'([+-])?P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$')
+feed_time_re=re.compile(r'(\d{4})-(\d\d)-(\d\d)(?:T(\d\d):(\d\d):(\d\d)(?:\.\d+)?(Z|([+-])(\d\d):(\d\d))?)?$')
+cache_version=2 # format of cache_file; a cache with another version is ignored
+cache_lock=thread.allocate_lock() # hold to write cache_file, from taking what's saved until it's in place; take before events_lock
+events_ready=threading.Event() # set once there are events to alarm: the cache is loaded or the first sync is done
+
+def parse_time(time_string):
+    """Parse a start or end time as found in the calendar feed into an aware datetime"""
+    # parse_unix_time() can mostly do without it
+    import dateutil.parser
+    import dateutil.tz
+    t=dateutil.parser.parse(time_string)
+    # Google sometimes does not supply timezones
+    # (for events that last more than a day and have no time set, apparently)
+    # python can't compare two dates if only one has TZ info
+    # this might screw us at, say, if DST changes between when we get the event and its alarm
+    #
+    # numeric offsets like +02:00 have no tzname(), so ask for the offset itself
+    if t.utcoffset() is None:
+        t=t.replace(tzinfo=dateutil.tz.tzlocal())
+    return t
+
+def unix_time(t):
+    """Unix time of an aware datetime"""
+    return timegm(t.utctimetuple())
+
+def parse_unix_time(time_string):
+    """
+    Unix time of a start or end time as found in the calendar feed
+    
+    The feed has either RFC 3339 times (2009-05-06T10:30:00.000+02:00) or
+    dates (2009-05-06, for all-day events, meaning local midnight); anything
+    else goes to parse_time(). Results are remembered in parsed_times{}.
+    """
+    try:
+        return parsed_times[time_string]
+    except KeyError:
+        pass
+    m = feed_time_re.match(time_string)
+    if not m:
+        t = unix_time(parse_time(time_string))
+    elif m.group(7):
+        t = timegm(tuple(int(x) for x in m.group(1, 2, 3, 4, 5, 6)))
+        if m.group(8): # not 'Z', so an offset from UTC
+            offset = 3600*int(m.group(9)) + 60*int(m.group(10))
+            t = m.group(8) == '+' and t - offset or t + offset
+    else:
+        # no timezone at all: local time, see parse_time()
+        t = int(time.mktime(tuple(int(x or 0) for x in m.group(1, 2, 3, 4, 5, 6)) + (0, 0, -1)))
+    parsed_times[time_string] = t
+    return t
 
 class GcEvent(object):
     """
     One event occurence (actually, one alarm for an event)
+
+    The times are worked out once, when the event is created; the displayed
+    strings only when first needed. Do not change the attributes afterwards.
     """
-    def __init__(self, title, where, start_string, end_string, minutes):
+    __slots__ = ('calendar', 'event_id', 'title', 'where', 'start_string', 'end_string', 'minutes',
+        'key', 'starttime_unix', 'endtime_unix', 'alarm_time_unix', '_starttime_str', '_endtime_str')
+
+    def __init__(self, calendar, event_id, title, where, start_string, end_string, minutes):
         """
+        calendar: id of the calendar the event is in
+        event_id: id of the event (same for all occurences of a recurring event)
         title: event title text
         where: where is the event (or empty string)
         start_string: event start time as string
         end_string: event end time as string
         minutes: how many minutes before the start is the alarm to go off
         """
+        self.calendar=calendar
+        self.event_id=event_id
         self.title=title
         self.where=where
-        self.start=dateutil.parser.parse(start_string)
-        self.end=dateutil.parser.parse(end_string)
-        # Google sometimes does not supply timezones
-        # (for events that last more than a day and have no time set, apparently)
-        # python can't compare two dates if only one has TZ info
-        # this might screw us at, say, if DST changes between when we get the event and its alarm
-        #
-        # workaround: tzname() can raise AttributeError if the timezone is None
-        # and it calls its .encode() method to return the value
-        try:
-            if not self.start.tzname():
-                self.start=self.start.replace(tzinfo=dateutil.tz.tzlocal())
-        except AttributeError:
-            self.start=self.start.replace(tzinfo=dateutil.tz.tzlocal())
-            
-        try:
-            if not self.end.tzname():
-                self.end=self.end.replace(tzinfo=dateutil.tz.tzlocal())
-        except AttributeError:
-            self.end=self.end.replace(tzinfo=dateutil.tz.tzlocal())
-            
+        self.start_string=start_string
+        self.end_string=end_string
         self.minutes=minutes
+        self.starttime_unix=parse_unix_time(start_string)
+        self.endtime_unix=parse_unix_time(end_string)
+        self.alarm_time_unix=self.starttime_unix-60*int(minutes)
+        self._starttime_str=None
+        self._endtime_str=None
+        # identifies this occurence/alarm across queries, even if its details change;
+        # by the start time itself, as Google and RecurringEvent write it differently
+        self.key=(calendar, event_id, self.starttime_unix, int(minutes))
 
     def get_starttime_str(self):
         """Start time in local timezone, as a preformatted string"""
-        return self.start.astimezone(dateutil.tz.tzlocal()).strftime(strftime_string)
+        if self._starttime_str is None:
+            self._starttime_str=time.strftime(strftime_string, time.localtime(self.starttime_unix))
+        return self._starttime_str
 
     def get_endtime_str(self):
         """End time in local timezone, as a preformatted string"""
-        return self.end.astimezone(dateutil.tz.tzlocal()).strftime(strftime_string)
-
-    def get_starttime_unix(self):
-        """Start time in unix time"""
-        return int(self.start.astimezone(dateutil.tz.tzlocal()).strftime('%s'))
-
-    def get_alarm_time_unix(self):
-        """Alarm time in unix time"""
-        return self.starttime_unix-60*int(self.minutes)
+        if self._endtime_str is None:
+            self._endtime_str=time.strftime(strftime_string, time.localtime(self.endtime_unix))
+        return self._endtime_str
 
     starttime_str=property(fget=get_starttime_str) 
     endtime_str=property(fget=get_endtime_str) 
-    starttime_unix=property(fget=get_starttime_unix) 
-    alarm_time_unix=property(fget=get_alarm_time_unix) 
 
     def alarm(self):
-        """Show the alarm box for one event/recurrence"""
+        """Log the alarm for one event/recurrence; returns the (title, body) of its notification"""
         message( " ***** ALARM ALARM ALARM: %s ****  " % self  )
+        metrics.inc('gcalert_alarms_total')
         if self.where:
-            a=pynotify.Notification( self.title, "<b>Starting:</b> %s\n<b>Where:</b> %s" % (self.starttime_str, self.where), icon)
+            return (self.title, "<b>Starting:</b> %s\n<b>Where:</b> %s" % (self.starttime_str, self.where))
         else:
-            a=pynotify.Notification( self.title, "<b>Starting:</b> %s" % self.starttime_str, icon)
-        # let the alarm stay until it's closed by hand (acknowledged)
-        a.set_timeout(pynotify.EXPIRES_NEVER)
-        if not a.show():
-            message( "Failed to send alarm notification!" )
+            return (self.title, "<b>Starting:</b> %s" % self.starttime_str)
 
     def __str__(self):
         return "Title: %s Where: %s Start: %s Alarm_minutes: %s" % ( self.title, self.where, self.starttime_str, self.minutes )
@@ -165,9 +350,23 @@ class GcEvent(object):
     def __repr__(self):
         return "GcEvent(%s, %s, %s, %s, %s)" % ( self.title, self.where, self.starttime_str, self.endtime_str, self.minutes )
 
-    # for the 'event in list_of_events' kind of checks (two instances with the same data are indeed considered equal)
+    # two instances of the same occurence/alarm are considered equal, see also same_details()
     def __eq__(self, other):
-        return self.__repr__() == other.__repr__()
+        return self.key == other.key
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def cache_record(self):
+        """The arguments this event was created with, for saving it to the cache_file"""
+        return [self.calendar, self.event_id, self.title, self.where, self.start_string, self.end_string, self.minutes]
+
+    def same_details(self, other):
+        """True if 'other' (an equal event) has not been modified compared to this one"""
+        return (self.title, self.where, self.endtime_unix) == (other.title, other.where, other.endtime_unix)
 
 
 # ----------------------------
@@ -180,79 +379,921 @@ def message(s):
 
 # ----------------------------
 
-def debug(s):
-    """Print debug message 's' if the debug_flag is set (running with -d option)"""
+def debug(s, *args):
+    """
+    Print debug message 's' if the debug_flag is set (running with -d option)
+    args: values for the %-formatting of 's', which is done only if the message is printed
+    """
     if (debug_flag):
+        if args:
+            s = s % args
         message("DEBUG: %s: %s" % (sys._getframe(1).f_code.co_name, s) )
 
 # ----------------------------
 
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answer GET /metrics with the metrics"""
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.text()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        debug(format, *args)
+
+def start_metrics_server():
+    """Serve the metrics on localhost:metrics_port from a thread of its own"""
+    try:
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', metrics_port), MetricsHandler)
+    except socket.error as error:
+        message("Could not serve metrics on port %d: %s" % (metrics_port, error))
+        return
+    thread.start_new_thread(server.serve_forever, ())
+    message("Serving metrics on http://127.0.0.1:%d/metrics" % metrics_port)
+
+def control_command(line):
+    """Carry out one command sent to the control_socket; returns the answer"""
+    words = line.split()
+    try:
+        if words == ['list']:
+            return '\n'.join(list_alarms() or ["No pending alarms"])
+        elif len(words) in (2, 3) and words[0] == 'snooze':
+            minutes = snooze_minutes
+            if len(words) == 3:
+                minutes = int(words[2])
+                if minutes < 1:
+                    return "Snooze for at least 1 minute"
+            return snooze_alarm(words[1], minutes)
+        elif len(words) == 2 and words[0] == 'dismiss':
+            return dismiss_alarm(words[1])
+    except ValueError:
+        pass
+    return "Unknown command '%s'; try 'list', 'snooze ID [MINUTES]' or 'dismiss ID'" % line.strip()
+
+def control_server(server):
+    """Answer the commands coming in on the listening 'server' socket, one per connection"""
+    while 1:
+        try:
+            (connection, address) = server.accept()
+        except socket.error as error:
+            if error.args[0] == errno.EINTR:
+                continue
+            message("Control socket %s failed: %s" % (control_socket, error))
+            return
+        try:
+            connection.settimeout(10)
+            line = connection.makefile('r').readline()
+            debug("control command: %s", line.strip())
+            connection.sendall(control_command(line) + '\n')
+        except socket.error as error:
+            debug("control connection failed: %s", error)
+        finally:
+            connection.close()
+
+def start_control_server():
+    """
+    Take commands on the control_socket from a thread of its own
+    returns: True if listening
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(control_socket)
+        message("Another gcalert is listening on %s, not taking commands" % control_socket)
+        return False
+    except socket.error:
+        pass # left over from a previous run, if it exists
+    finally:
+        client.close()
+    try:
+        if os.path.exists(control_socket):
+            os.unlink(control_socket)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.settimeout(None) # not fetch_timeout
+        # only we may send commands
+        umask = os.umask(0077)
+        try:
+            server.bind(control_socket)
+        finally:
+            os.umask(umask)
+        server.listen(5)
+    except (socket.error, OSError) as error:
+        message("Could not listen on %s: %s" % (control_socket, error))
+        return False
+    thread.start_new_thread(control_server, (server,))
+    debug("listening on %s", control_socket)
+    return True
+
+def send_command(command):
+    """
+    Send 'command' to the gcalert listening on the control_socket and print its answer
+    returns: True if there was an answer
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    answer = ''
+    try:
+        client.settimeout(10)
+        client.connect(control_socket)
+        client.sendall(command + '\n')
+        client.shutdown(socket.SHUT_WR)
+        while 1:
+            data = client.recv(4096)
+            if not data:
+                break
+            answer += data
+    except socket.error as error:
+        print "Could not reach gcalert on %s: %s" % (control_socket, error)
+        return False
+    finally:
+        client.close()
+    print answer.rstrip('\n')
+    return True
+
+# ----------------------------
+
 # signal handlers are easier than wrapping the whole show
 # into one giant try/except looking for KeyboardInterrupt
 # besides we have two threads to shut down
 def stopthismadness(signl, frme):
-    """Hook up signal handler for ^C"""
-    message("shutting down on SIGINT")
-    sys.exit(0)
+    """Hook up signal handler for ^C and SIGTERM: make the main loop stop"""
+    global shutdown_requested
+    message("shutting down on signal %d" % signl)
+    shutdown_requested = True
+    wake_alarm_thread()
+
+# ----------------------------
+
+class Account(object):
+    """
+    One Google account being watched, with the events of its calendars
+    
+    All accounts share events_lock, alarm_queue[] and the fetch_worker threads.
+    """
+    def __init__(self, name, password=None, calendarservice=None):
+        """
+        name: the Google username
+        password: to make the calendarservice with, when it is first needed
+        calendarservice: as returned by get_calendar_service(), if there is one already
+        """
+        self.name = name
+        self.password = password
+        self.calendarservice = calendarservice
+        self.events = {} # events seen so far whose alarm is yet to go off, by their key -> their alarm_queue entry
+        self.alarmed_events = {} # events (occurences etc) already alarmed or dismissed, by their key
+        self.alarmed_expiry = [] # heap of (start time, key) of alarmed_events{}; they are forgotten when the event starts
+        self.calendar_states = {} # calendar -> CalendarState, what we got from it so far
+        self.calendar_names = {} # calendar -> its name, for the calendars being watched
+        self.connected = False # logged in to Google
+        self.login_failures = 0 # failed logins in a row
+        self.query_failures = 0 # failed queries in a row
+        self.query_sleeptime = None # seconds between queries last logged, before jitter; None after a failure
+        self.next_sync = 0 # unix time to log in or query next
+
+    def service(self):
+        """The calendarservice of this account, made the first time it's needed; call from the main thread"""
+        if self.calendarservice is None:
+            self.calendarservice = get_calendar_service(self.name, self.password)
+        return self.calendarservice
+
+def schedule_alarm(account, e, alarm_time=None):
+    """
+    Add event 'e' to account.events{} and alarm_queue[]; hold events_lock when calling this
+    alarm_time: when to go off, if not at e.alarm_time_unix (when snoozed)
+    """
+    entry=[alarm_time or e.alarm_time_unix, alarm_sequence.next(), e, account]
+    account.events[e.key]=entry
+    heapq.heappush(alarm_queue, entry)
+
+def mark_alarmed(account, e):
+    """Remember that event 'e' was alarmed or dismissed, so it is not scheduled again; hold events_lock"""
+    account.alarmed_events[e.key]=e
+    heapq.heappush(account.alarmed_expiry, (e.starttime_unix, e.key))
+
+def evict_alarmed(account, now):
+    """Forget the alarmed events of 'account' that have started by 'now'; hold events_lock"""
+    expiry = account.alarmed_expiry
+    while expiry and expiry[0][0] <= now:
+        (starttime, key) = heapq.heappop(expiry)
+        e = account.alarmed_events.get(key)
+        # it may have been snoozed, or alarmed again with another start time
+        if e is not None and e.starttime_unix <= now:
+            del account.alarmed_events[key]
+
+def unschedule_alarm(account, key):
+    """Remove the event with 'key' from account.events{}; its alarm_queue[] entry is dropped when it comes up"""
+    entry=account.events.pop(key)
+    entry[2]=None
+
+def replace_scheduled_event(account, e):
+    """Swap in a modified copy of an already scheduled event; its alarm time is the same"""
+    account.events[e.key][2]=e
+
+def alarm_id(account, e):
+    """Short id of the alarm of event 'e', the same across queries and restarts, for snoozing and dismissing it"""
+    return '%08x' % (zlib.crc32(repr((account.name, e.key))) & 0xffffffff)
+
+def add_pending(account, e):
+    """
+    Remember that the alarm of event 'e' was shown, until it's dismissed or the event is over; hold events_lock
+    returns: its alarm id
+    """
+    i = alarm_id(account, e)
+    if i not in pending_alarms:
+        heapq.heappush(pending_expiry, (e.endtime_unix, i))
+    pending_alarms[i] = [account, e, None]
+    return i
+
+def evict_pending(now):
+    """Forget the pending alarms of events that are over by 'now'; hold events_lock"""
+    while pending_expiry and pending_expiry[0][0] <= now:
+        (endtime, i) = heapq.heappop(pending_expiry)
+        p = pending_alarms.get(i)
+        if p is None:
+            continue # dismissed
+        if p[1].endtime_unix > now:
+            # alarmed again since, with another end time
+            heapq.heappush(pending_expiry, (p[1].endtime_unix, i))
+        else:
+            del pending_alarms[i]
+
+def snooze_alarm(i, minutes):
+    """
+    Have the pending alarm with id 'i' go off again 'minutes' minutes from now
+    returns: what was done, as a message
+    """
+    events_lock.acquire()
+    try:
+        p = pending_alarms.get(i)
+        if p is None:
+            return "No pending alarm %s" % i
+        (account, e) = p[:2]
+        entry = account.events.get(e.key)
+        if entry is not None:
+            # snoozed again before it went off; it may have been modified meanwhile
+            e = entry[2]
+            unschedule_alarm(account, e.key)
+        account.alarmed_events.pop(e.key, None)
+        p[1:] = [e, clock.time() + 60 * minutes]
+        schedule_alarm(account, e, p[2])
+    finally:
+        events_lock.release()
+    wake_alarm_thread()
+    save_cache()
+    return "Snoozed for %d minutes: %s" % (minutes, e)
+
+def dismiss_alarm(i):
+    """
+    Forget about the pending alarm with id 'i'; if it was snoozed, it doesn't go off again
+    returns: what was done, as a message
+    """
+    events_lock.acquire()
+    try:
+        p = pending_alarms.pop(i, None)
+        if p is None:
+            return "No pending alarm %s" % i
+        (account, e) = p[:2]
+        entry = account.events.get(e.key)
+        if entry is not None:
+            e = entry[2]
+            unschedule_alarm(account, e.key)
+            mark_alarmed(account, e)
+    finally:
+        events_lock.release()
+    save_cache()
+    return "Dismissed: %s" % e
+
+def list_alarms():
+    """The pending alarms, one line each, soonest event first"""
+    events_lock.acquire()
+    try:
+        evict_pending(clock.time())
+        pending = sorted(pending_alarms.items(), key=lambda (i, p): (p[1].starttime_unix, i))
+    finally:
+        events_lock.release()
+    lines = []
+    for (i, (account, e, until)) in pending:
+        lines.append("%s  %s  %s%s" % (i, e.starttime_str, e.title,
+            until and "  (snoozed until %s)" % time.strftime(strftime_string, time.localtime(until)) or ''))
+    return lines
+
+def wake_alarm_thread():
+    """Make process_events_thread (or the EventLoop) re-check alarm_queue[] now instead of when it planned to"""
+    try:
+        os.write(wakeup_pipe[1], 'x')
+    except OSError:
+        # pipe is full: there is a wakeup pending already
+        pass
+
+# ----------------------------
+
+def save_cache():
+    """Save the events and alarmed_events of all accounts to the cache_file, atomically"""
+    if not cache_file:
+        return
+    saved = {}
+    # held from the snapshot on, so an older one can't be written over a newer one
+    cache_lock.acquire()
+    events_lock.acquire()
+    for account in accounts:
+        saved[account.name] = {
+            'events': [ entry[2].cache_record() for entry in account.events.itervalues() if entry[0] == entry[2].alarm_time_unix ],
+            'snoozed': [ [entry[0]] + entry[2].cache_record() for entry in account.events.itervalues() if entry[0] != entry[2].alarm_time_unix ],
+            'alarmed': [ e.cache_record() for e in account.alarmed_events.itervalues() ],
+            'calendars': account.calendar_names }
+    events_lock.release()
+    try:
+        data = json.dumps({'version': cache_version, 'saved': int(clock.time()), 'accounts': saved}, separators=(',',':'))
+        # write a new file and rename it over the old one so that
+        # the cache_file is either the old or the new one, never half-written
+        tmp_file = '%s.tmp' % cache_file
+        f = os.fdopen(os.open(tmp_file, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0600), 'w')
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(tmp_file, cache_file)
+        debug("saved %d accounts to %s", len(saved), cache_file)
+    except (IOError, OSError) as error:
+        message("Could not write cache file %s: %s" % (cache_file, error))
+    finally:
+        cache_lock.release()
+
+def cached_event(record):
+    """Make a GcEvent from what GcEvent.cache_record() returned"""
+    # strings are handled as utf-8 everywhere else, like gdata returns them
+    return GcEvent(*[ isinstance(x, unicode) and x.encode('utf-8') or x for x in record ])
+
+def load_cache():
+    """
+    Schedule the events saved to the cache_file by a previous run, and
+    remember which ones were alarmed already so they are not alarmed again.
+    returns: True if any events were scheduled
+    """
+    if not cache_file:
+        return False
+    try:
+        data = json.load(open(cache_file))
+    except IOError as error:
+        debug("no cache loaded: %s", error)
+        return False
+    except ValueError:
+        message("Cache file %s is corrupt, ignoring it" % cache_file)
+        return False
+    if not isinstance(data, dict) or data.get('version') != cache_version:
+        message("Cache file %s has an unknown format, ignoring it" % cache_file)
+        return False
+    now = clock.time()
+    loaded = 0
+    events_lock.acquire()
+    try:
+        for account in accounts:
+            saved = data['accounts'].get(account.name)
+            if not saved:
+                continue
+            # alarms already shown are honoured however old the cache is
+            for record in saved['alarmed']:
+                e = cached_event(record)
+                if now < e.starttime_unix:
+                    mark_alarmed(account, e)
+            if now - data['saved'] <= cache_max_age:
+                # the filters may have changed since the cache was saved
+                names = saved.get('calendars', {})
+                for record in saved['events']:
+                    e = cached_event(record)
+                    if (now < e.starttime_unix and e.key not in account.alarmed_events and e.key not in account.events
+                            and calendar_wanted(e.calendar, names.get(e.calendar)) and title_wanted(e.title)):
+                        schedule_alarm(account, e)
+                for record in saved.get('snoozed', []):
+                    e = cached_event(record[1:])
+                    if now < e.endtime_unix and e.key not in account.events:
+                        pending_alarms[add_pending(account, e)][2] = record[0]
+                        schedule_alarm(account, e, record[0])
+                loaded += len(account.events)
+        if now - data['saved'] > cache_max_age:
+            message("Cache file %s is too old, waiting for Google" % cache_file)
+        else:
+            message("%d events loaded from %s" % (loaded, cache_file))
+    except (KeyError, TypeError, ValueError, AttributeError) as error:
+        message("Cache file %s is corrupt, ignoring it: %s" % (cache_file, error))
+        loaded = 0
+        for account in accounts:
+            for k in account.events.keys():
+                unschedule_alarm(account, k)
+            account.alarmed_events.clear()
+            del account.alarmed_expiry[:]
+        pending_alarms.clear()
+        del pending_expiry[:]
+    finally:
+        events_lock.release()
+    return loaded > 0
+
+# ----------------------------
+
+def google_error_string(error):
+    """Describe an error coming from the gdata library, as well as we can"""
+    try:
+        return "%d %s" % (error.args[0]['status'], error.args[0]['reason'])
+    except Exception:
+        return "unknown error: %s" % error
+
+# ----------------------------
+
+def fetch_worker():
+    """Run jobs from fetch_jobs forever, put (job id, success, result or exception) to their result queue"""
+    while 1:
+        (job_id, function, args, results) = fetch_jobs.get()
+        try:
+            results.put((job_id, True, function(*args)))
+        except Exception as error:
+            results.put((job_id, False, error))
+
+def start_fetch_workers():
+    """Make sure 'fetch_workers' fetch_worker threads are running"""
+    global fetch_workers_started
+    fetch_workers_lock.acquire()
+    while fetch_workers_started < fetch_workers:
+        thread.start_new_thread(fetch_worker,())
+        fetch_workers_started += 1
+    fetch_workers_lock.release()
+
+def calendar_query(username, start_date, end_date, updated_min=None):
+    """
+    Query for the events happening between the given dates in one calendar
+    updated_min: if set, only events changed since then are returned, including deleted ones
+    """
+    # imported already, by get_calendar_service()
+    import gdata.calendar.service
+    query = gdata.calendar.service.CalendarEventQuery(username, 'private', 'full')
+    query.start_min = start_date
+    query.start_max = end_date 
+    query.max_results = feed_page_size
+    if updated_min:
+        query.updated_min = updated_min
+        query['showdeleted'] = 'true'
+    if local_recurrence:
+        # recurring events are still found by their occurences in the date range,
+        # but are expanded into 'when's over an empty range: they come as their rules only
+        query['recurrence-expansion-start'] = start_date
+        query['recurrence-expansion-end'] = start_date
+    return query
+
+def feed_pages(calendarservice, query):
+    """Yield the pages of the feed returned for 'query', fetching each only when the previous one is done"""
+    feed = calendarservice.CalendarQuery(query)
+    while 1:
+        next_link = feed.GetNextLink()
+        yield feed
+        feed = None # nothing of it is needed any more
+        if next_link is None:
+            break
+        # the link is a full URL, not a query; CalendarQuery() only takes the latter
+        feed = calendarservice.GetCalendarEventFeed(next_link.href)
+
+def calendar_wanted(calendar, name):
+    """True if the calendar with id 'calendar' and name 'name' is to be watched, according to --include and --exclude"""
+    def matches(patterns):
+        for pattern in patterns:
+            if fnmatch.fnmatch(calendar.lower(), pattern) or (name and fnmatch.fnmatch(name.lower(), pattern)):
+                return True
+        return False
+    return (not calendar_includes or matches(calendar_includes)) and not matches(calendar_excludes)
+
+def title_regex(patterns):
+    """One compiled regex matching what any of the regexes in 'patterns' does, None if there are none"""
+    if not patterns:
+        return None
+    return re.compile('|'.join([ '(?:%s)' % p for p in patterns ]))
+
+def title_wanted(title):
+    """True if events titled 'title' are to be alarmed, according to --title and --skip-title"""
+    title = title or ''
+    if title_include_re and not title_include_re.search(title):
+        return False
+    return not (title_exclude_re and title_exclude_re.search(title))
+
+def entry_where(an_event):
+    """The 'where' of a gdata event entry, as a string"""
+    try:
+        # join all 'where' entries together; you probably only have one anyway
+        return ' // '.join(map(lambda w: w.value_string, an_event.where))
+    except TypeError:
+        # not all events have 'where' fields (value_string fields), and that's okay
+        return ''
+
+def entry_events(username, an_event):
+    """Make a GcEvent out of each (occurence x 'alert' reminder) of one gdata event entry"""
+    event_list=[]
+    if not title_wanted(an_event.title.text):
+        # an event renamed to something filtered out is dropped like one without reminders
+        debug("skipping event: %s", an_event.title.text)
+        return event_list
+    where_string=entry_where(an_event)
+
+    # make a GcEvent out of each (event x reminder x occurence)
+    for a_when in an_event.when:
+        for a_rem in a_when.reminder:
+            debug("google event TEXT: %s METHOD: %s", an_event.title.text, a_rem.method)
+            if a_rem.method == 'alert': # 'popup' in the web interface
+                # event (one for each alarm instance) is done,
+                # add it to the list
+                this_event=GcEvent(
+                            username,
+                            an_event.id.text,
+                            an_event.title.text,
+                            where_string,
+                            a_when.start_time,
+                            a_when.end_time,
+                            a_rem.minutes)
+                debug("new GcEvent occurence: %s", this_event)
+                event_list.append(this_event)
+    return event_list
+
+def is_cancelled(an_event):
+    """True if the gdata event entry is a deleted event or a cancelled occurence"""
+    try:
+        return an_event.event_status.value.endswith('canceled')
+    except AttributeError:
+        return False
+
+def ical_time(params, value):
+    """
+    Parse an iCalendar DATE or DATE-TIME 'value' with its 'params' (dict) into an aware datetime
+    returns: (datetime, True if it's a date only)
+    """
+    import dateutil.tz
+    if params.get('VALUE') == 'DATE' or len(value) == 8:
+        # all-day events are from midnight to midnight wherever we are
+        return (datetime.datetime(int(value[0:4]), int(value[4:6]), int(value[6:8]), tzinfo=dateutil.tz.tzlocal()), True)
+    # no strptime(): it's not safe to use first from a fetch_worker in python 2
+    t = datetime.datetime(int(value[0:4]), int(value[4:6]), int(value[6:8]), int(value[9:11]), int(value[11:13]), int(value[13:15]))
+    if value.endswith('Z'):
+        return (t.replace(tzinfo=dateutil.tz.tzutc()), False)
+    # a time without a zone is in local time
+    return (t.replace(tzinfo=params.get('TZID') and dateutil.tz.gettz(params['TZID']) or dateutil.tz.tzlocal()), False)
+
+def ical_duration(value):
+    """Parse an iCalendar DURATION into a timedelta"""
+    m = ical_duration_re.match(value)
+    if m is None:
+        raise ValueError("bad duration %s" % value)
+    (weeks, days, hours, minutes, seconds) = [ int(x or 0) for x in m.groups()[1:] ]
+    d = datetime.timedelta(weeks=weeks, days=days, hours=hours, minutes=minutes, seconds=seconds)
+    return m.group(1) == '-' and -d or d
+
+def ical_rule(value, dtstart):
+    """
+    An rrule of the RRULE or EXRULE 'value', starting at 'dtstart'
+    UNTIL has to be in UTC with an aware dtstart, which it isn't always.
+    """
+    import dateutil.rrule
+    import dateutil.tz
+    def utc_until(m):
+        v = m.group(1)
+        if len(v) == 8:
+            # the whole day is included
+            until = datetime.datetime(int(v[0:4]), int(v[4:6]), int(v[6:8]), 23, 59, 59)
+        else:
+            until = datetime.datetime(int(v[0:4]), int(v[4:6]), int(v[6:8]), int(v[9:11]), int(v[11:13]), int(v[13:15]))
+        # in the time zone of the event, like DTSTART
+        until = until.replace(tzinfo=dtstart.tzinfo)
+        return 'UNTIL=%s' % until.astimezone(dateutil.tz.tzutc()).strftime('%Y%m%dT%H%M%SZ')
+    return dateutil.rrule.rrulestr(re.sub(r'UNTIL=(\d{8}(?:T\d{6})?)(?=;|$)', utc_until, value), dtstart=dtstart)
+
+def parse_recurrence(text):
+    """
+    Parse the iCalendar recurrence of a gdata event entry
+    returns: (rruleset of the occurence start times, duration as timedelta, True if all-day)
+    raises: ValueError if it can't be made sense of
+    """
+    import dateutil.rrule
+    lines = []
+    # unfold continuation lines; the VTIMEZONE that may follow is not needed, TZIDs are Olson names
+    for line in text.replace('\r\n', '\n').replace('\n ', '').split('\n'):
+        if line.startswith('BEGIN:'):
+            break
+        if ':' in line:
+            (head, value) = line.split(':', 1)
+            parts = head.split(';')
+            lines.append((parts[0].upper(), dict([ p.split('=', 1) for p in parts[1:] if '=' in p ]), value.strip()))
+    try:
+        (dtstart, all_day) = [ ical_time(params, value) for (name, params, value) in lines if name == 'DTSTART' ][0]
+    except IndexError:
+        raise ValueError("no DTSTART")
+    duration = datetime.timedelta(days=all_day and 1 or 0)
+    rules = dateutil.rrule.rruleset()
+    for (name, params, value) in lines:
+        if name == 'DTEND':
+            duration = ical_time(params, value)[0] - dtstart
+        elif name == 'DURATION':
+            duration = ical_duration(value)
+        elif name == 'RRULE':
+            rules.rrule(ical_rule(value, dtstart))
+        elif name == 'EXRULE':
+            rules.exrule(ical_rule(value, dtstart))
+        elif name in ('RDATE', 'EXDATE'):
+            for v in value.split(','):
+                if '/' in v:
+                    continue # PERIOD, not seen from Google
+                t = ical_time(params, v)[0]
+                if name == 'RDATE':
+                    rules.rdate(t)
+                else:
+                    rules.exdate(t)
+    # the first occurence is DTSTART, whether the rules say so or not
+    rules.rdate(dtstart)
+    return (rules, duration, all_day)
+
+class RecurringEvent(object):
+    """
+    A recurring event as it comes with --local-recurrence: its rules, out of
+    which GcEvents are made only for the occurences coming up soon
+    """
+    def __init__(self, calendar, event_id, title, where, recurrence, minutes):
+        """
+        recurrence: the iCalendar recurrence text of the event
+        minutes: list of how many minutes before the start the alarms are to go off
+        Others as for GcEvent.
+        """
+        self.calendar=calendar
+        self.event_id=event_id
+        self.title=title
+        self.where=where
+        self.minutes=minutes
+        self.recurrence=recurrence
+        (self.rules, self.duration, self.all_day) = parse_recurrence(recurrence)
+        # the rules are walked from the first occurence on each time, so
+        # what's coming up is worked out further ahead than asked for, once
+        self.upcoming = [] # (unix time, aware datetime) of the occurences starting within upcoming_range
+        self.upcoming_range = (0, 0) # unix times
+
+    def same_details(self, title, where, recurrence, minutes):
+        """True if this is what a RecurringEvent made of these would be"""
+        return (self.title, self.where, self.recurrence, self.minutes) == (title, where, recurrence, minutes)
+
+    def time_string(self, t):
+        """Occurence time 't' (aware datetime) the way the calendar feed has it"""
+        import dateutil.tz
+        if self.all_day:
+            return t.strftime('%Y-%m-%d')
+        return t.astimezone(dateutil.tz.tzutc()).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+    def occurences(self, start, end, exceptions=()):
+        """
+        GcEvents of each (occurence x reminder) whose alarm can go off before unix time 'end',
+        of the occurences starting after unix time 'start'
+        exceptions: start unix times of occurences that were modified or cancelled
+        """
+        import dateutil.tz
+        end += 60 * max([ int(m) for m in self.minutes ])
+        if start < self.upcoming_range[0] or end > self.upcoming_range[1]:
+            until = end + (end - start)
+            self.upcoming = [ (unix_time(t), t) for t in self.rules.between(datetime.datetime.fromtimestamp(start, dateutil.tz.tzutc()),
+                datetime.datetime.fromtimestamp(until, dateutil.tz.tzutc()), inc=True) ]
+            self.upcoming_range = (start, until)
+        event_list = []
+        for (u, t) in self.upcoming:
+            if u < start or u > end or u in exceptions:
+                continue
+            (start_string, end_string) = (self.time_string(t), self.time_string(t + self.duration))
+            for m in self.minutes:
+                event_list.append(GcEvent(self.calendar, self.event_id, self.title, self.where, start_string, end_string, m))
+        return event_list
+
+def entry_series(username, an_event, old=None):
+    """
+    A RecurringEvent for a gdata event entry that came with its recurrence rules
+    old: the RecurringEvent of this entry from the previous sync, kept if unchanged
+    returns: None if it's filtered out, has no popup reminders or can't be parsed
+    """
+    if not title_wanted(an_event.title.text):
+        debug("skipping event: %s", an_event.title.text)
+        return None
+    # the reminders of recurring events are those of the entry, not of the 'when's
+    minutes = [ r.minutes for r in getattr(an_event, 'reminder', None) or [] if r.method == 'alert' ]
+    if not minutes:
+        return None
+    where = entry_where(an_event)
+    if old is not None and old.same_details(an_event.title.text, where, an_event.recurrence.text, minutes):
+        return old
+    try:
+        return RecurringEvent(username, an_event.id.text, an_event.title.text, where, an_event.recurrence.text, minutes)
+    except (ValueError, TypeError, IndexError, OverflowError) as error:
+        message("Could not understand when %s recurs (%s), skipping it" % (an_event.title.text, error))
+        return None
+
+def exception_of(an_event):
+    """
+    Which occurence of which recurring event the gdata event entry 'an_event' is a
+    modified or cancelled exception of
+    returns: (id of the recurring event, start unix time of the occurence), None if it's not an exception
+    """
+    try:
+        original = an_event.original_event
+        # exceptions live in the same feed as the recurring event they belong to
+        return ('%s/%s' % (an_event.id.text.rsplit('/', 1)[0], original.id), parse_unix_time(original.when.start_time))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+class CalendarState(object):
+    """
+    What we know about one calendar, so that next time only the changes need to be asked for
+    """
+    def __init__(self):
+        self.updated = None # 'updated' time of the last feed, in Google's own clock
+        self.date_range = None # (start_date, end_date) of the last query
+        self.full_sync_time = 0 # unix time of the last query for all events
+        self.events = {} # event id -> list of its GcEvents
+        self.series = {} # event id -> RecurringEvent, with --local-recurrence
+        self.exceptions = {} # event id of a recurring event -> set of start unix times of its modified or cancelled occurences
+
+    def needs_full_sync(self, start_date, end_date, now):
+        """True if all events have to be downloaded, not just the changed ones"""
+        return (not self.updated
+            or self.date_range != (start_date, end_date) # new days in the window
+            or now - self.full_sync_time >= full_sync_sleeptime)
+
+    def sync(self, calendarservice, username, start_date, end_date, full, now):
+        """
+        Query Google for the events of this calendar, all or only the changed ones
+        returns: number of entries in the feed
+
+        The feed is processed page by page as it arrives, and only the GcEvents
+        are kept of it; run by a fetch_worker.
+        """
+        if full:
+            # the old ones stay in use until these are complete
+            (events, series, exceptions) = ({}, {}, {})
+            updated_min = None
+        else:
+            (events, series, exceptions) = (self.events, self.series, self.exceptions)
+            updated_min = self.updated
+        sync_start = time.time()
+        updated = None
+        count = 0
+        for page in feed_pages(calendarservice, calendar_query(username, start_date, end_date, updated_min)):
+            if updated is None:
+                try:
+                    updated = page.updated.text
+                except AttributeError:
+                    updated = '' # no delta queries without Google's timestamp
+            entries = page.entry
+            page = None
+            parsed = 0
+            for an_event in entries:
+                exception = exception_of(an_event)
+                if exception:
+                    exceptions.setdefault(exception[0], set()).add(exception[1])
+                    # moved or cancelled, the occurence is not where the recurring event had it;
+                    # a moved one has GcEvents of its own, under its own id
+                    if exception[0] in events:
+                        events[exception[0]] = [ e for e in events[exception[0]] if e.starttime_unix != exception[1] ]
+                if is_cancelled(an_event):
+                    debug("deleted event: %s", an_event.id.text)
+                    events.pop(an_event.id.text, None)
+                    series.pop(an_event.id.text, None)
+                elif local_recurrence and getattr(an_event, 'recurrence', None) is not None:
+                    # its GcEvents are made below, for the occurences coming up
+                    a_series = entry_series(username, an_event, self.series.get(an_event.id.text))
+                    if a_series:
+                        series[an_event.id.text] = a_series
+                    else:
+                        series.pop(an_event.id.text, None)
+                        events.pop(an_event.id.text, None)
+                else:
+                    occurences = entry_events(username, an_event)
+                    parsed += len(occurences)
+                    if an_event.id.text in exceptions:
+                        # its exceptions may have come first
+                        occurences = [ e for e in occurences if e.starttime_unix not in exceptions[an_event.id.text] ]
+                    if occurences:
+                        events[an_event.id.text] = occurences
+                    else:
+                        # no popup reminders (any more)
+                        events.pop(an_event.id.text, None)
+            count += len(entries)
+            entries = None
+            metrics.inc('gcalert_events_parsed_total', parsed)
+        # the horizon moves on with every sync, so all series are expanded again
+        for (event_id, a_series) in series.iteritems():
+            occurences = a_series.occurences(now, now + recurrence_horizon, exceptions.get(event_id, ()))
+            if occurences:
+                events[event_id] = occurences
+            else:
+                events.pop(event_id, None)
+        self.events = events
+        self.series = series
+        self.exceptions = exceptions
+        self.updated = updated
+        self.date_range = (start_date, end_date)
+        if full:
+            self.full_sync_time = now
+        metrics.observe('gcalert_calendar_sync_seconds', time.time() - sync_start, (('calendar', username), ('full', full and 'yes' or 'no')))
+        return count
 
 # ----------------------------
 
-def date_range_query(calendarservice, start_date='2007-01-01', end_date='2007-07-01'):
+def connection_lost(error):
+    """Report an error that means Google can't be reached or we were logged out"""
+    debug("Google connection lost: %s", error)
+    message( "Google connection lost (%s), will re-connect" % google_error_string(error) )
+
+def calendar_list(account):
+    """
+    Get the list of 'magic strings' used to identify each calendar of 'account' to be watched
+
+    Calendars left out by --include and --exclude are never queried.
+    """
+    feed = account.calendarservice.GetAllCalendarsFeed()
+    names = {}
+    for entry in feed.entry:
+        # in there is the full feed URL and we need the last part (=='username')
+        username = urllib.unquote(entry.id.text.split('/')[-1])
+        name = getattr(entry.title, 'text', None) or ''
+        if calendar_wanted(username, name):
+            names[username] = name
+        else:
+            debug("skipping calendar: %s (%s)", username, name)
+    metrics.set('gcalert_calendars_skipped', len(feed.entry) - len(names), (('account', account.name),))
+    account.calendar_names = names
+    return names.keys()
+
+def calendar_sync_jobs(account, username_list, start_date, end_date):
+    """
+    Plan the sync of each calendar in 'username_list', forgetting about unsubscribed calendars
+    returns: list of (calendar, function, arguments) for the fetch_worker threads
+    """
+    parsed_times.clear()
+    for username in [ u for u in account.calendar_states if u not in username_list ]:
+        del account.calendar_states[username]
+    now = clock.time()
+    jobs = []
+    for username in username_list:
+        state = account.calendar_states.setdefault(username, CalendarState())
+        full = state.needs_full_sync(start_date, end_date, now)
+        if full:
+            debug("processing username: %s, all events", username)
+        else:
+            debug("processing username: %s, changes since %s", username, state.updated)
+        jobs.append((username, state.sync, (account.calendarservice, username, start_date, end_date, full, now)))
+    return jobs
+
+def calendar_sync_results(account, results):
+    """
+    Put together what the jobs from calendar_sync_jobs() returned
+    results: list of (calendar, success, number of entries or exception)
+    returns: (success, list of events, set of calendars that could not be queried)
+    """
+    event_list=[] # our parsed event list
+    failed_calendars=set()
+    for (username, success, result) in results:
+        state = account.calendar_states[username]
+        if success:
+            debug("%d events from calendar %s", result, username)
+        else:
+            debug("Query of calendar %s failed: %s", username, result)
+            message( "Could not get events of calendar %s (%s), skipping it" % (username, google_error_string(result)) )
+            failed_calendars.add(username)
+            metrics.inc('gcalert_calendar_sync_failures_total', 1, (('calendar', username),))
+            # Google may refuse to give changes since too long ago; start over
+            state.updated = None
+    if results and len(failed_calendars) == len(results):
+        message( "Google connection lost, will re-connect" )
+        return (False, [], failed_calendars)
+
+    for state in account.calendar_states.itervalues():
+        for occurences in state.events.itervalues():
+            event_list += occurences
+    return (True, event_list, failed_calendars)
+
+def date_range_query(account, start_date='2007-01-01', end_date='2007-07-01'):
     """
     Get a list of events happening between the given dates in all calendars the user has
-    calendarservice: Calendar Service as returned by get_calendar_service()
-    returns: (success, list of events)
+    account: whose calendars to query, an Account
+    returns: (success, list of events, set of calendars that could not be queried)
     
     Each reminder occurence creates a new event (new GcEvent object)
+    The calendars are queried in parallel by the fetch_worker threads; one failing
+    calendar is skipped, only all of them failing counts as a lost connection.
+    Mostly only the events changed since the previous query are downloaded, and
+    merged into account.calendar_states{}; every full_sync_sleeptime seconds, or when
+    the date range moves, all events are.
     """
-    google_events=[] # events in all the Google Calendars
-    event_list=[] # our parsed event list
     try:
-        feed = calendarservice.GetAllCalendarsFeed()
-        # Get the list of 'magic strings' used to identify each calendar
-        # in there is the full feed URL and we need the last part (=='username')
-        username_list = map(lambda x: urllib.unquote(x.id.text.split('/')[-1]), feed.entry) 
-        for username in username_list:
-            query = gdata.calendar.service.CalendarEventQuery(username, 'private', 'full')
-            query.start_min = start_date
-            query.start_max = end_date 
-            debug("processing username: %s" % username)
-            google_events += calendarservice.CalendarQuery(query).entry
-            debug("events so far: %d" % len(google_events))
+        username_list = calendar_list(account)
     except Exception as error: # FIXME clearer
-        debug( "Google connection lost: %s" % error )
-        try:
-            message( "Google connection lost (%d %s), will re-connect" % (error.args[0]['status'], error.args[0]['reason']) )
-        except Exception:
-            message( "Google connection lost with unknown error, will re-connect: %s " % error )
-            message( "Please report this as a bug." )
-        return (False, [])
-
-    for an_event in google_events:
-        where_string=''
-        try:
-            # join all 'where' entries together; you probably only have one anyway
-            where_string=' // '.join(map(lambda w: w.value_string, an_event.where))
-        except TypeError:
-            # not all events have 'where' fields (value_string fields), and that's okay
-            pass
-
-        # make a GcEvent out of each (event x reminder x occurence)
-        for a_when in an_event.when:
-            for a_rem in a_when.reminder:
-                debug("google event TEXT: %s METHOD: %s" % (an_event.title.text, a_rem.method) )
-                if a_rem.method == 'alert': # 'popup' in the web interface
-                    # event (one for each alarm instance) is done,
-                    # add it to the list
-                    this_event=GcEvent(
-                                an_event.title.text,
-                                where_string,
-                                a_when.start_time,
-                                a_when.end_time,
-                                a_rem.minutes)
-                    debug("new GcEvent occurence: %s" % this_event)
-                    event_list.append(this_event)
-    return (True, event_list)
+        connection_lost(error)
+        return (False, [], set())
+    jobs = calendar_sync_jobs(account, username_list, start_date, end_date)
+    start_fetch_workers()
+    results = Queue.Queue()
+    for (username, function, args) in jobs:
+        fetch_jobs.put((username, function, args, results))
+    return calendar_sync_results(account, [ results.get() for job in jobs ])
 
 # ----------------------------
 def do_login(calendarservice):
@@ -264,10 +1305,12 @@ def do_login(calendarservice):
     returns: True or False (logged-in or failed)
     
     """
+    metrics.inc('gcalert_login_attempts_total')
     try:
         calendarservice.ProgrammaticLogin()
     except Exception as error:
-        debug( 'Failed to authenticate to Google: %s' % error )
+        metrics.inc('gcalert_login_failures_total')
+        debug('Failed to authenticate to Google: %s', error)
         message( 'Failed to authenticate to Google as %s' % calendarservice.email )
         message( 'Check username, password and that the account is enabled.' )
         return False
@@ -275,42 +1318,205 @@ def do_login(calendarservice):
     return True # we're logged in
 
 # -------------------------------------------------------------------------------------------
-def process_events_thread():
-    """Process events and raise alarms via pynotify"""
-    # initialize notification system
-    if not pynotify.init('gcalert-Calendar_Alerter-%s' % myversion):
-        print "Could not initialize pynotify / libnotify!"
+class LibnotifyNotifier(object):
+    """Shows notifications on the desktop via pynotify, with snooze and dismiss buttons if the daemon can and gobject is there"""
+    def init(self):
+        global pynotify, gobject
+        try:
+            import pynotify
+        except ImportError as error:
+            missing_dependency(error)
+        if not pynotify.init('gcalert-Calendar_Alerter-%s' % myversion):
+            return False
+        self.shown = {} # id -> notifications with buttons; the callbacks are gone with the objects
+        self.actions = 'actions' in pynotify.get_server_caps()
+        if self.actions:
+            try:
+                import gobject
+            except ImportError as error:
+                message("No buttons on notifications without python-gobject (%s); snooze and dismiss with --command" % error)
+                self.actions = False
+        if self.actions:
+            # button presses come in through the glib main loop
+            gobject.threads_init()
+            thread.start_new_thread(gobject.MainLoop().run, ())
+        return True
+
+    def show(self, title, body, alarm_ids):
+        a=pynotify.Notification(title, body, icon)
+        # let the alarm stay until it's closed by hand (acknowledged)
+        a.set_timeout(pynotify.EXPIRES_NEVER)
+        if self.actions:
+            a.add_action('snooze', 'Snooze %d min' % snooze_minutes, lambda *args: self.pressed(a, snooze_alarm, alarm_ids, snooze_minutes))
+            a.add_action('dismiss', 'Dismiss', lambda *args: self.pressed(a, dismiss_alarm, alarm_ids))
+            a.connect('closed', lambda n: self.shown.pop(id(n), None))
+            self.shown[id(a)] = a
+        return a.show()
+
+    def pressed(self, a, function, alarm_ids, *args):
+        """A button of notification 'a' was pressed; do function(alarm id, *args) to its alarms"""
+        for i in alarm_ids:
+            message(function(i, *args))
+        self.shown.pop(id(a), None)
+
+class StdoutNotifier(object):
+    """Prints notifications; for running without a desktop"""
+    def init(self):
+        return True
+
+    def show(self, title, body, alarm_ids):
+        print "%s gcalert.py: NOTIFICATION [%s]: %s: %s" % (time.asctime(), ' '.join(alarm_ids), title, body.replace('\n', ' '))
+        sys.stdout.flush()
+        return True
+
+class FileNotifier(object):
+    """Appends notifications, one per line, to a file or FIFO"""
+    def __init__(self, path):
+        self.path = path
+
+    def init(self):
+        return True
+
+    def show(self, title, body, alarm_ids):
+        try:
+            # opened each time: a FIFO may have lost its reader meanwhile;
+            # without one, opening it fails at once (ENXIO) instead of blocking
+            # until there is one, which would show this late, and once per retry
+            fd = os.open(self.path, os.O_WRONLY|os.O_APPEND|os.O_CREAT|os.O_NONBLOCK, 0666)
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+            f = os.fdopen(fd, 'a')
+            f.write("%d\t%s\t%s\t%s\n" % (time.time(), title, body.replace('\n', ' '), ' '.join(alarm_ids)))
+            f.close()
+        except (IOError, OSError) as error:
+            debug("could not write %s: %s", self.path, error)
+            return False
+        return True
+
+def make_notifier(backend):
+    """The notifier object for a notify_backend setting, None if there is no such backend"""
+    if backend == 'libnotify':
+        return LibnotifyNotifier()
+    elif backend == 'stdout':
+        return StdoutNotifier()
+    elif backend.startswith('file:'):
+        return FileNotifier(backend[len('file:'):])
+    return None
+
+def show_notification(title, body, alarm_ids):
+    """
+    Show one notification with 'notifier', giving up after notify_timeout seconds
+    alarm_ids: of the alarms shown, to snooze or dismiss them from the notification
+    returns: True if it was shown
+    """
+    results = Queue.Queue()
+    def show():
+        try:
+            results.put(notifier.show(title, body, alarm_ids))
+        except Exception as error:
+            debug("notification failed: %s", error)
+            results.put(False)
+    # in a thread of its own so that a hung notification daemon can't hang us
+    thread.start_new_thread(show, ())
+    try:
+        return results.get(True, notify_timeout)
+    except Queue.Empty:
+        message("Notification was not shown in %d seconds" % notify_timeout)
+        return False
+
+def batch_notification(batch):
+    """(title, body) of the notification for the GcEvents in 'batch', alarmed together"""
+    notifications = [ e.alarm() for e in batch ]
+    if len(batch) == 1:
+        return notifications[0]
+    return ("%d events" % len(batch),
+        '\n'.join([ "<b>%s</b> %s%s" % (e.starttime_str, e.title, e.where and " (%s)" % e.where or '') for e in batch ]))
+
+def notification_thread():
+    """Show the alarms put on notification_queue, retrying failed notifications"""
+    while 1:
+        (batch, alarm_ids) = notification_queue.get()
+        (title, body) = batch_notification(batch)
+        for attempt in range(notify_retries + 1):
+            if attempt:
+                time.sleep(2 ** (attempt - 1))
+            if show_notification(title, body, alarm_ids):
+                break
+            metrics.inc('gcalert_notification_failures_total')
+        else:
+            message( "Failed to send alarm notification!" )
+
+def init_notifications():
+    """Initialize the notification system, exit if that's not possible"""
+    global notifier
+    notifier = make_notifier(notify_backend)
+    if not notifier.init():
+        print "Could not initialize notifications (%s)!" % notify_backend
         sys.exit(1)
-    time.sleep(threads_offset) # give a chance for the other thread to get some events
+    thread.start_new_thread(notification_thread, ())
+    # a full pipe must not block the threads waking the alarm loop up
+    fcntl.fcntl(wakeup_pipe[1], fcntl.F_SETFL, fcntl.fcntl(wakeup_pipe[1], fcntl.F_GETFL) | os.O_NONBLOCK)
+
+def fire_due_alarms():
+    """
+    Go off with every alarm that's due
+    returns: seconds until the next alarm, or None if none are scheduled
+    """
+    nowunixtime = clock.time()
+    batch = []
+    alarm_ids = []
+    events_lock.acquire()
+    # go off with everything that's due, and what's due in a moment so that
+    # they come in one notification; the earliest alarm is always on top
+    while alarm_queue and alarm_queue[0][0] <= nowunixtime + coalesce_sleeptime:
+        (alarm_time, sequence, e, account) = heapq.heappop(alarm_queue)
+        if e is None:
+            continue # deleted or modified since it was scheduled
+        del account.events[e.key]
+        # snoozed alarms still go off after the start, until the event is over
+        if alarm_time > e.alarm_time_unix and e.endtime_unix < nowunixtime or alarm_time <= e.alarm_time_unix and e.starttime_unix < nowunixtime:
+            debug("dropping %s, is gone", e)
+            continue
+        metrics.observe('gcalert_alarm_lateness_seconds', clock.time() - alarm_time)
+        mark_alarmed(account, e)
+        batch.append(e)
+        alarm_ids.append(add_pending(account, e))
+    evict_pending(nowunixtime)
+    metrics.set('gcalert_alarms_pending', len(pending_alarms))
+    if alarm_queue:
+        sleeptime = max(0, alarm_queue[0][0] - nowunixtime)
+        debug("next alarm in %d seconds", sleeptime)
+    else:
+        sleeptime = None # nothing to do until a sync adds something
+        debug("no alarms scheduled")
+    events_lock.release()
+    if batch:
+        # shown by notification_thread, so a slow notification daemon doesn't hold us up
+        notification_queue.put((batch, alarm_ids))
+        # a restart must not show these again
+        save_cache()
+    return sleeptime
+
+def wait_for_wakeup(sleeptime):
+    """Sleep 'sleeptime' seconds (None: forever) or until wake_alarm_thread() is called"""
+    try:
+        if clock.select([wakeup_pipe[0]], sleeptime):
+            os.read(wakeup_pipe[0], 4096)
+    except select.error as error:
+        # a signal came; whoever waits checks shutdown_requested
+        if error.args[0] != errno.EINTR:
+            raise
+
+def process_events_thread():
+    """Process events and raise alarms via the notification_thread"""
+    # nothing to do until the cache is loaded or the other thread has got some events
+    events_ready.wait()
     while 1:
-        nowunixtime = time.time()
         debug("running")
-        events_lock.acquire()
-        for e in events:
-            if e.starttime_unix < nowunixtime:
-                debug("removing %s, is gone" % e)
-                events.remove(e)
-                # also free up some memory
-                if e in alarmed_events:
-                    alarmed_events.remove(e)
-            # it starts in the future
-            # check for alarm times if it wasn't alarmed yet
-            elif e not in alarmed_events:
-                # check alarm time. If it's now-ish, raise alarm
-                # otherwise, let the event sleep some more
-                # alarm now if the alarm has 'started'
-                if nowunixtime >= e.alarm_time_unix:
-                    e.alarm()
-                    alarmed_events.append(e)
-                else:
-                    debug("not yet: \"%s\" (%s) [now:%d, alarm:%d]" % ( e.title, e.starttime_str, nowunixtime, e.alarm_time_unix ))
-            else:
-                debug("already alarmed: \"%s\" (%s) [now:%d, alarm:%d]" % ( e.title, e.starttime_str, nowunixtime, e.alarm_time_unix ))
-        events_lock.release()
+        sleeptime = fire_due_alarms()
         debug("finished")
-        # we can't just sleep until the next event as the other thread MIGHT
-        # add something new meanwhile
-        time.sleep(alarm_sleeptime)
+        # sleep until the next alarm is due, or until the other thread
+        # has changed alarm_queue[] and woke us up
+        wait_for_wakeup(sleeptime)
 
 def usage():
     """Print usage information."""
@@ -320,32 +1526,103 @@ def usage():
     print " -s F, --secret=F     : specify location of a file containing"
     print "                        username and password, newline-separated"
     print "                        Default: $HOME/.gcalert_secret"
+    print "                        Give it more than once to watch several"
+    print "                        accounts"
+    print " --accounts=F         : watch the accounts whose secret files are"
+    print "                        listed in file F, one per line"
     print " -d, --debug          : produce debug messages"
     print " -u, --quiet          : disables all non-debug messages"
     print " -q N, --query=N      : poll Google every N seconds for newly"
-    print "                        added events (default: %d)" % query_sleeptime
-    print " -a M, --alarm=M      : awake and produce alarms every N "
-    print "                        seconds (default: %d)" % alarm_sleeptime
+    print "                        added events, when no alarms are coming"
+    print "                        up (default: %d)" % query_sleeptime
+    print " --query-min=N        : poll Google at most every N seconds, when"
+    print "                        alarms are coming up (default: %d)" % query_min_sleeptime
+    print " -a M, --alarm=M      : ignored, alarms are produced when they are"
+    print "                        due; kept for compatibility"
     print " -l L, --look=L       : \"look ahead\" L days in the calendar"
     print "                        for events (default: %d)" % lookahead_days
     print " -r R, --retry=R      : sleep R seconds between reconnect"
-    print "                        attempts (default: %d)" % login_retry_sleeptime
+    print "                        attempts, doubled for each failed attempt"
+    print "                        (default: %d)" % login_retry_sleeptime
+    print " --retry-max=R        : sleep at most R seconds between reconnect"
+    print "                        attempts (default: %d)" % retry_max_sleeptime
     print " -t F, --timeformat=F : set strftime(3) string for displaying"
     print "                        event start times (default: '%s')" % strftime_string
     print " -i I, --icon=I       : set the icon to display in "
     print "                        notifications (default: '%s')" % icon
+    print " --cache=F            : save events to file F, to have them before"
+    print "                        Google can be reached after a restart;"
+    print "                        empty to disable (default: $HOME/.gcalert_cache)"
+    print " --cache-age=S        : do not use cached events older than S"
+    print "                        seconds (default: %d)" % cache_max_age
+    print " --full-sync=S        : download all events every S seconds;"
+    print "                        in between only changes are downloaded"
+    print "                        (default: %d)" % full_sync_sleeptime
+    print " --local-recurrence   : download recurring events once, as their"
+    print "                        rules, instead of each occurence; makes"
+    print "                        long look aheads cheap"
+    print " --horizon=S          : with --local-recurrence, set up alarms of"
+    print "                        recurring events S seconds ahead; syncs"
+    print "                        must succeed more often than that"
+    print "                        (default: %d)" % recurrence_horizon
+    print " --notify=N           : show alarms with 'libnotify', on 'stdout',"
+    print "                        or append them to a file or FIFO with"
+    print "                        'file:/path' (default: %s)" % notify_backend
+    print " --coalesce=S         : show alarms going off within S seconds"
+    print "                        as one notification (default: %d)" % coalesce_sleeptime
+    print " --engine=E           : 'threads' to run alarms and syncing in"
+    print "                        threads of their own, 'loop' to run them"
+    print "                        from one event loop (default: %s)" % engine
+    print " --metrics-port=P     : serve metrics for Prometheus on"
+    print "                        http://127.0.0.1:P/metrics (default: off)"
+    print " --include=C          : watch only the calendars whose id or name"
+    print "                        matches C (* and ? allowed); give it more"
+    print "                        than once to watch several (default: all)"
+    print " --exclude=C          : do not watch the calendars whose id or name"
+    print "                        matches C, e.g. '*holiday*'; can be given"
+    print "                        more than once"
+    print " --title=R            : alarm only events whose title matches the"
+    print "                        regex R; can be given more than once"
+    print " --skip-title=R       : do not alarm events whose title matches the"
+    print "                        regex R; can be given more than once"
+    print " --control=F          : take commands on the Unix socket F; empty"
+    print "                        to disable (default: $HOME/.gcalert_control)"
+    print " --command=C          : send command C to the gcalert running and"
+    print "                        exit; commands: 'list' (the alarms shown),"
+    print "                        'snooze ID [MINUTES]', 'dismiss ID'"
+    print " --snooze=M           : snooze alarms for M minutes by default"
+    print "                        (default: %d)" % snooze_minutes
+    print " --fetch-workers=N    : query N calendars at the same time"
+    print "                        (default: %d)" % fetch_workers
+    print " --fetch-timeout=S    : give up on a calendar query after S"
+    print "                        seconds (default: %d)" % fetch_timeout
 
-def get_calendar_service():
+def missing_dependency(error):
+    """Exit because one of the separate packages could not be imported"""
+    print "Dependency was not found! %s" % error
+    print "(Try: sudo apt-get install python-notify python-gdata python-dateutil notification-daemon)"
+    sys.exit(1)
+
+def check_dependencies():
+    """Exit if a package needed with the current settings is not installed, without importing it yet"""
+    modules = ['gdata', 'dateutil']
+    if notify_backend == 'libnotify':
+        modules += ['pynotify']
+    for name in modules:
+        try:
+            imp.find_module(name)
+        except ImportError as error:
+            missing_dependency(error)
+
+def read_secrets(secrets_file):
     """
-    Get hold of a CalendarService() and stick username/password info in it, plus some settings.
-    Return the results if successful, exit the program if not.
+    Read username and password from 'secrets_file'
+    Return them if successful, exit the program if not.
     """
-    # get credentials from file
-    cs = gdata.calendar.service.CalendarService()
     try:
         # the 'password file' should contain two lines with username and password
         # the :2 is there to allow a newline at the end
-        (cs.email, cs.password) = open(secrets_file).read().split('\n')[:2]
+        (username, password) = open(secrets_file).read().split('\n')[:2]
     except IOError as error:
         print error 
         sys.exit(1)
@@ -356,6 +1633,19 @@ def get_calendar_service():
         print "Something unhandled went wrong reading your password file '%s', please report this as a bug." % secrets_file
         print error
         sys.exit(3)
+    return (username, password)
+
+def get_calendar_service(username, password):
+    """
+    Get hold of a CalendarService() and stick username/password info in it, plus some settings.
+    gdata is imported the first time this is called; call from the main thread.
+    """
+    try:
+        import gdata.calendar.service
+    except ImportError as error:
+        missing_dependency(error)
+    cs = gdata.calendar.service.CalendarService()
+    (cs.email, cs.password) = (username, password)
 
     # Full-fledged SSL needs the SSL patch (to python-gdata_1.2.4-0ubuntu2 at least)
     # see http://groups.google.com/group/gdata-python-client-library-contributors/browse_thread/thread/48254170a6f6818a?pli=1
@@ -368,42 +1658,232 @@ def get_calendar_service():
     cs.source = 'gcalert-Calendar_Alerter-%s' % myversion
     return cs
 
+def merge_events(account, newevents, failed_calendars):
+    """
+    Bring account.events{} in line with what the last date_range_query() returned
+    returns: (number of events added, removed, changed)
+    """
+    # keyed outside the lock; the lock is only held for the diff
+    newevents = dict( (n.key, n) for n in newevents )
+    (added, removed, changed) = (0, 0, 0)
+    events = account.events
+    alarmed_events = account.alarmed_events
+    events_lock.acquire()
+    now = clock.time()
+    # remove stale events
+    # (if their calendar could be queried; key[0] is the calendar)
+    for k in [ k for k in events if k not in newevents and k[0] not in failed_calendars ]:
+        unschedule_alarm(account, k)
+        removed += 1
+    # alarms of events that have started are no longer needed
+    evict_alarmed(account, now)
+    # add new events, pick up modified ones
+    for (k, n) in newevents.iteritems():
+        if k in alarmed_events:
+            continue
+        entry = events.get(k)
+        if entry is None:
+            # does it start in the future?
+            if now < n.starttime_unix:
+                schedule_alarm(account, n)
+                added += 1
+        elif not entry[2].same_details(n):
+            replace_scheduled_event(account, n)
+            changed += 1
+    (scheduled, alarmed) = (len(events), len(alarmed_events))
+    events_lock.release()
+    metrics.set('gcalert_events_scheduled', scheduled, (('account', account.name),))
+    metrics.set('gcalert_events_alarmed', alarmed, (('account', account.name),))
+    if added or removed:
+        wake_alarm_thread()
+    return (added, removed, changed)
+
+def jittered(seconds):
+    """'seconds', give or take poll_jitter"""
+    return seconds * random.uniform(1 - poll_jitter, 1 + poll_jitter)
+
+def backoff(seconds, failures):
+    """Sleep time after 'failures' errors in a row: 'seconds', doubled for each further error"""
+    return min(retry_max_sleeptime, seconds * 2 ** min(failures - 1, 32))
+
+def next_query_sleeptime(account):
+    """
+    Seconds until the next query of 'account': half the time until its next alarm,
+    so late changes to it are noticed, between query_min_sleeptime and query_sleeptime
+    """
+    events_lock.acquire()
+    next_alarm = min([ entry[0] for entry in account.events.itervalues() ] or [None])
+    events_lock.release()
+    if next_alarm is None:
+        return query_sleeptime
+    return max(query_min_sleeptime, min(query_sleeptime, (next_alarm - clock.time()) / 2))
+
+def login_done(account, connected):
+    """
+    Take the result of do_login() for 'account'
+    returns: seconds until the next try, if the login failed
+    """
+    account.connected = connected
+    if connected:
+        account.login_failures = 0
+        return 0
+    # wrong password, locked account: no point in trying often
+    account.login_failures += 1
+    sleeptime = jittered(backoff(login_retry_sleeptime, account.login_failures))
+    message("will re-connect as %s in %d seconds" % (account.name, sleeptime))
+    return sleeptime
+
+def query_range():
+    """(start, end) dates of the date_range_query() to do now"""
+    # today
+    range_start = time.strftime("%Y-%m-%d",time.localtime(clock.time()))
+    # tommorrow, or later
+    range_end=time.strftime("%Y-%m-%d",time.localtime(clock.time()+lookahead_days*24*3600))
+    return (range_start, range_end)
+
+def query_done(account, result):
+    """
+    Take the result of date_range_query() for 'account'
+    returns: seconds until the next query
+    """
+    (account.connected,newevents,failed_calendars) = result
+    if not account.connected:
+        # usually the network, or the login expired
+        account.query_failures += 1
+        account.query_sleeptime = None
+        sleeptime = jittered(backoff(query_min_sleeptime, account.query_failures))
+        message("will re-connect as %s in %d seconds" % (account.name, sleeptime))
+        return sleeptime
+    # we're still logged in, the query was successful and newevents is valid
+    account.query_failures = 0
+    (added, removed, changed) = merge_events(account, newevents, failed_calendars)
+    if added or removed or changed:
+        message("events of %s: %d added, %d removed, %d changed" % (account.name, added, removed, changed))
+    else:
+        debug("events of %s: no changes", account.name)
+    save_cache()
+    interval = int(next_query_sleeptime(account))
+    if interval != account.query_sleeptime:
+        message("will query %s every %d seconds" % (account.name, interval))
+        account.query_sleeptime = interval
+    sleeptime = jittered(interval)
+    debug("finished %s, next query in %d seconds", account.name, sleeptime)
+    return sleeptime
+
+def sync_account(account):
+    """
+    Log in to Google and/or sync the events of one account, whichever is due
+    returns: seconds until this should be done again
+    """
+    if not account.connected:
+        sleeptime = login_done(account, do_login(account.service()))
+        if not account.connected:
+            return sleeptime
+    debug("running for %s", account.name)
+    (range_start, range_end) = query_range()
+    return query_done(account, date_range_query(account, range_start, range_end))
+
 def update_events_thread():
-    """Periodically sync the 'events' list to what's in Google Calendar"""
-    connectionstatus = do_login(cs)
-    while 1:
-        if(not connectionstatus):
-            time.sleep(login_retry_sleeptime)
-            connectionstatus = do_login(cs)
+    """Periodically sync the events of all accounts to what's in Google Calendar, until shutdown is requested"""
+    while not shutdown_requested:
+        for account in accounts:
+            if account.next_sync <= clock.time() and not shutdown_requested:
+                sleeptime = sync_account(account)
+                # whatever came of it, process_events_thread can start
+                events_ready.set()
+                metrics.set('gcalert_poll_interval_seconds', sleeptime, (('account', account.name),))
+                account.next_sync = clock.time() + sleeptime
+        # a signal cuts this short
+        clock.sleep(max(0, min([ a.next_sync for a in accounts ]) - clock.time()))
+
+class EventLoop(object):
+    """
+    Alarms and syncing in one select() loop in the main thread (--engine=loop),
+    instead of process_events_thread and update_events_thread
+    
+    gdata's requests to Google block, so they still run on the fetch_worker
+    threads; these hand back the results through put() and the loop carries on
+    with the sync from there. Accounts are synced the same way sync_account() does.
+    """
+    def __init__(self):
+        self.completions = Queue.Queue() # (callback, success, result or exception) of jobs done
+        self.syncing = set() # accounts with a login or query under way
+
+    def put(self, completion):
+        """Take a finished job from a fetch_worker; 'self' is their result queue"""
+        self.completions.put(completion)
+        wake_alarm_thread()
+
+    def submit(self, function, args, callback):
+        """Have function(*args) run by a fetch_worker, then callback(success, result) by the loop"""
+        fetch_jobs.put((callback, function, args, self))
+
+    def start_sync(self, account):
+        """Log in and/or start querying 'account'"""
+        self.syncing.add(account)
+        if account.connected:
+            self.start_query(account)
         else:
-            debug("running")
-            # today
-            range_start = time.strftime("%Y-%m-%d",time.localtime())
-            # tommorrow, or later
-            range_end=time.strftime("%Y-%m-%d",time.localtime(time.time()+lookahead_days*24*3600))
-            (connectionstatus,newevents) = date_range_query(cs, range_start, range_end)
-            if connectionstatus: # if we're still logged in, the query was successful and newevents is valid
-                events_lock.acquire()
-                now = time.time()
-                # remove stale events, if the new event list is valid
-                for n in events:
-                    if not (n in newevents):
-                        debug('Event deleted or modified: %s' % n)
-                        events.remove(n)
-                # add new events to the list
-                for n in newevents:
-                    debug('Is new event N really new? THIS: %s' % n)
-                    if not (n in events):
-                        debug('Not seen before: %s' % n)
-                        # does it start in the future?
-                        if now < n.starttime_unix:
-                            debug("-> future, adding")
-                            events.append(n)
-                        else:
-                            debug("-> past already")
-                events_lock.release()
-            debug("finished")
-            time.sleep(query_sleeptime)
+            self.submit(do_login, (account.service(),),
+                lambda success, connected: self.logged_in(account, success and connected))
+
+    def logged_in(self, account, connected):
+        sleeptime = login_done(account, connected)
+        if account.connected:
+            self.start_query(account)
+        else:
+            self.sync_done(account, sleeptime)
+
+    def start_query(self, account):
+        debug("running for %s", account.name)
+        (range_start, range_end) = query_range()
+        self.submit(calendar_list, (account,),
+            lambda success, result: self.calendars_listed(account, range_start, range_end, success, result))
+
+    def calendars_listed(self, account, range_start, range_end, success, result):
+        if not success:
+            connection_lost(result)
+            self.sync_done(account, query_done(account, (False, [], set())))
+            return
+        jobs = calendar_sync_jobs(account, result, range_start, range_end)
+        results = []
+        if not jobs:
+            self.sync_done(account, query_done(account, calendar_sync_results(account, results)))
+        for (username, function, args) in jobs:
+            self.submit(function, args,
+                lambda success, result, username=username: self.calendar_synced(account, len(jobs), results, (username, success, result)))
+
+    def calendar_synced(self, account, count, results, result):
+        results.append(result)
+        if len(results) == count:
+            self.sync_done(account, query_done(account, calendar_sync_results(account, results)))
+
+    def sync_done(self, account, sleeptime):
+        metrics.set('gcalert_poll_interval_seconds', sleeptime, (('account', account.name),))
+        account.next_sync = clock.time() + sleeptime
+        self.syncing.discard(account)
+
+    def run(self):
+        """Go off with alarms and sync accounts when they are due, until shutdown is requested"""
+        # alarms from the cache can go off before gdata is loaded for the first sync
+        fire_due_alarms()
+        start_fetch_workers()
+        while not shutdown_requested:
+            for account in accounts:
+                if account not in self.syncing and account.next_sync <= clock.time():
+                    self.start_sync(account)
+            while 1:
+                try:
+                    (callback, success, result) = self.completions.get_nowait()
+                except Queue.Empty:
+                    break
+                callback(success, result)
+            sleeptimes = [ a.next_sync - clock.time() for a in accounts if a not in self.syncing ]
+            next_alarm = fire_due_alarms()
+            if next_alarm is not None:
+                sleeptimes.append(next_alarm)
+            # 0 if an account is overdue already, e.g. after a slow save_cache()
+            wait_for_wakeup(max(0, min(sleeptimes)) if sleeptimes else None)
 
 if __name__ == '__main__':
     # -------------------------------------------------------------------------------------------
@@ -412,12 +1892,15 @@ if __name__ == '__main__':
     #
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hdus:q:a:l:r:t:i:", ["help", "debug", "quiet", "secret=", "query=", "alarm=", "look=", "retry=", "timeformat=", "icon="])
+        opts, args = getopt.getopt(sys.argv[1:], "hdus:q:a:l:r:t:i:", ["help", "debug", "quiet", "secret=", "query=", "alarm=", "look=", "retry=", "timeformat=", "icon=", "fetch-workers=", "fetch-timeout=", "cache=", "cache-age=", "full-sync=", "metrics-port=", "query-min=", "retry-max=", "accounts=", "engine=", "notify=", "coalesce=", "include=", "exclude=", "title=", "skip-title=", "control=", "command=", "snooze=", "local-recurrence", "horizon="])
     except getopt.GetoptError as err:
         # print help information and exit:
         print str(err) # will print something like "option -a not recognized"
         sys.exit(2)
 
+    title_includes = []
+    title_excludes = []
+    command = None
     try:
         for o, a in opts:
             if o == "-d":
@@ -428,44 +1911,164 @@ if __name__ == '__main__':
             elif o in ("-u", "--quiet"):
                 quiet_flag = True
             elif o in ("-s", "--secret"):
-                secrets_file = a
-                debug("secrets_file set to %s" % secrets_file)
+                secrets_files.append(a)
+                debug("secrets_files set to %s", secrets_files)
+            elif o == "--accounts":
+                try:
+                    # one secrets file per line
+                    for line in open(a):
+                        if line.strip() and not line.strip().startswith('#'):
+                            secrets_files.append(os.path.expanduser(line.strip()))
+                except IOError as error:
+                    print error
+                    sys.exit(1)
+                debug("secrets_files set to %s", secrets_files)
             elif o in ("-q", "--query"):
                 query_sleeptime = int(a) # FIXME handle non-integers graciously
-                debug("query_sleeptime set to %d" % query_sleeptime)
+                debug("query_sleeptime set to %d", query_sleeptime)
             elif o in ("-a", "--alarm"):
                 alarm_sleeptime = int(a)
-                debug("alarm_sleeptime set to %d" % alarm_sleeptime)
+                debug("alarm_sleeptime set to %d", alarm_sleeptime)
+            elif o == "--query-min":
+                query_min_sleeptime = int(a)
+                debug("query_min_sleeptime set to %d", query_min_sleeptime)
             elif o in ("-l", "--look"):
                 lookahead_days = int(a)
-                debug("lookahead_days set to %d" % lookahead_days)
+                debug("lookahead_days set to %d", lookahead_days)
             elif o in ("-r", "--retry"):
                 login_retry_sleeptime = int(a)
-                debug("login_retry_sleeptime set to %d" % login_retry_sleeptime)
+                debug("login_retry_sleeptime set to %d", login_retry_sleeptime)
+            elif o == "--retry-max":
+                retry_max_sleeptime = int(a)
+                debug("retry_max_sleeptime set to %d", retry_max_sleeptime)
             elif o in ("-t", "--timeformat"):
                 strftime_string = a
-                debug("strftime_string set to %s" % strftime_string)
+                debug("strftime_string set to %s", strftime_string)
             elif o in ("-i", "--icon"):
                 icon = a
-                debug("icon set to %s" % icon)
+                debug("icon set to %s", icon)
+            elif o == "--cache":
+                cache_file = a
+                debug("cache_file set to %s", cache_file)
+            elif o == "--cache-age":
+                cache_max_age = int(a)
+                debug("cache_max_age set to %d", cache_max_age)
+            elif o == "--full-sync":
+                full_sync_sleeptime = int(a)
+                debug("full_sync_sleeptime set to %d", full_sync_sleeptime)
+            elif o == "--notify":
+                if not make_notifier(a):
+                    print "Unknown notification backend %s; use '-h' for help." % a
+                    sys.exit(2)
+                notify_backend = a
+                debug("notify_backend set to %s", notify_backend)
+            elif o == "--coalesce":
+                coalesce_sleeptime = int(a)
+                debug("coalesce_sleeptime set to %d", coalesce_sleeptime)
+            elif o == "--engine":
+                if a not in ('threads', 'loop'):
+                    print "Engine should be 'threads' or 'loop'; use '-h' for help."
+                    sys.exit(2)
+                engine = a
+                debug("engine set to %s", engine)
+            elif o == "--metrics-port":
+                metrics_port = int(a)
+                debug("metrics_port set to %d", metrics_port)
+            elif o == "--fetch-workers":
+                fetch_workers = int(a)
+                debug("fetch_workers set to %d", fetch_workers)
+            elif o == "--fetch-timeout":
+                fetch_timeout = int(a)
+                debug("fetch_timeout set to %d", fetch_timeout)
+            elif o == "--include":
+                calendar_includes.append(a.lower())
+                debug("calendar_includes set to %s", calendar_includes)
+            elif o == "--exclude":
+                calendar_excludes.append(a.lower())
+                debug("calendar_excludes set to %s", calendar_excludes)
+            elif o == "--title":
+                title_includes.append(a)
+            elif o == "--skip-title":
+                title_excludes.append(a)
+            elif o == "--control":
+                control_socket = a
+                debug("control_socket set to %s", control_socket)
+            elif o == "--command":
+                command = a
+            elif o == "--snooze":
+                snooze_minutes = int(a)
+                if snooze_minutes < 1:
+                    print "Snooze for at least 1 minute; use '-h' for help."
+                    sys.exit(2)
+                debug("snooze_minutes set to %d", snooze_minutes)
+            elif o == "--local-recurrence":
+                local_recurrence = True
+            elif o == "--horizon":
+                recurrence_horizon = int(a)
+                debug("recurrence_horizon set to %d", recurrence_horizon)
             else:
                 assert False, "unhandled option"
     except ValueError:
         print "Option %s requires an integer parameter; use '-h' for help." % o
         sys.exit(1)
 
-    cs = get_calendar_service()
+    # compiled once, matched against every event entry downloaded
+    try:
+        title_include_re = title_regex(title_includes)
+        title_exclude_re = title_regex(title_excludes)
+    except re.error as error:
+        print "Bad title regex (%s); use '-h' for help." % error
+        sys.exit(2)
+    debug("title_include_re: %s title_exclude_re: %s", title_include_re and title_include_re.pattern, title_exclude_re and title_exclude_re.pattern)
+
+    if command is not None:
+        if not control_socket:
+            print "No control socket to send the command to; use '-h' for help."
+            sys.exit(2)
+        sys.exit(not send_command(command) and 1 or 0)
+
+    # gdata has no timeouts of its own; this applies to every query it makes
+    socket.setdefaulttimeout(fetch_timeout)
+
+    check_dependencies()
+
+    for f in secrets_files or [secrets_file]:
+        (username, password) = read_secrets(f)
+        if username in [ a.name for a in accounts ]:
+            print "Account %s is given more than once." % username
+            sys.exit(2)
+        accounts.append(Account(username, password))
+
+    if metrics_port:
+        start_metrics_server()
+
+    # alarms can go off from the cache while Google is still being contacted
+    if load_cache():
+        events_ready.set()
+
+    controlled = control_socket and start_control_server()
 
     # set up ^C handler
     signal.signal( signal.SIGINT, stopthismadness ) 
-
-    # start up the event processing thread
-    debug("Starting p_e_t")
-    thread.start_new_thread(process_events_thread,())
+    signal.signal( signal.SIGTERM, stopthismadness ) 
 
     # starting up
     message("gcalert %s running..." % myversion)
-    debug("SETTINGS: secrets_file: %s alarm_sleeptime: %d query_sleeptime: %d lookahead_days: %d login_retry_sleeptime: %d strftime_string: %s" % ( secrets_file, alarm_sleeptime, query_sleeptime, lookahead_days, login_retry_sleeptime, strftime_string ))
+    debug("SETTINGS: secrets_files: %s alarm_sleeptime: %d query_sleeptime: %d query_min_sleeptime: %d lookahead_days: %d login_retry_sleeptime: %d retry_max_sleeptime: %d strftime_string: %s fetch_workers: %d fetch_timeout: %d full_sync_sleeptime: %d cache_file: %s cache_max_age: %d engine: %s notify_backend: %s coalesce_sleeptime: %d", secrets_files or [secrets_file], alarm_sleeptime, query_sleeptime, query_min_sleeptime, lookahead_days, login_retry_sleeptime, retry_max_sleeptime, strftime_string, fetch_workers, fetch_timeout, full_sync_sleeptime, cache_file, cache_max_age, engine, notify_backend, coalesce_sleeptime)
     
-    update_events_thread()
+    init_notifications()
+    if engine == 'loop':
+        EventLoop().run()
+    else:
+        # start up the event processing thread
+        debug("Starting p_e_t")
+        thread.start_new_thread(process_events_thread,())
+        update_events_thread()
+
+    # whatever was alarmed or fetched last should survive
+    save_cache()
+    if controlled:
+        os.unlink(control_socket)
+    message("gcalert stopped")
+    sys.exit(0)
 
@@ -0,0 +1,912 @@
+#!/usr/bin/python
+# vim: ai expandtab
+#
+# Simulation and benchmark harness for gcalert.py.
+#
+# Runs gcalert's syncing and alarm logic (date_range_query, sync_account,
+# fire_due_alarms: what update_events_thread and process_events_thread do,
+# or with --engine=loop, EventLoop.run() itself, stopped by a SIGTERM)
+# against a fake Google Calendar serving synthetic calendars, on a virtual
+# clock, so that days of running take seconds. Events are edited, added and
+# deleted between polls. The results can be saved and compared to those of
+# another version. Syncs are not expected to fail, nor the EventLoop to wait
+# for nothing while an account is to be synced; if either happens, the exit
+# status is 1.
+#
+# With --bench, parts of gcalert are timed on their own instead, over the
+# same synthetic calendars; see benchmarks{}. With --check, cases that the
+# synthetic calendars don't cover are checked instead; see checks[].
+#
+# Requires the same packages as gcalert.py, but no network or desktop.
+#
+# Home: http://github.com/raas/gcalert
+#
+# ----------------------------------------------------------------------------
+#
+# Copyright 2009 Andras Horvath (andras.horvath nospamat gmailcom) This
+# program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ----------------------------------------------------------------------------
+
+import getopt
+import sys
+import time
+import urllib
+import random
+import resource
+import json
+import re
+import Queue
+import os
+import thread
+import select
+import signal
+import fcntl
+import tempfile
+import datetime
+from calendar import timegm
+
+import gcalert
+
+# -------------------------------------------------------------------------------------------
+# default values for parameters
+
+num_accounts = 1
+num_calendars = 10 # per account
+num_events = 50 # recurring events per calendar
+max_reminders = 3 # each event gets 0..max_reminders reminders, mostly popups
+sim_days = 3 # simulate this many days of running
+edits_per_hour = 20 # events edited, added or deleted per hour, per account
+fetch_delay = 0.0 # real seconds each request for the events of a calendar takes, as if Google was slow to answer
+failing_calendars = 0 # requests for the events of this many calendars of each account fail
+seed = 1 # for the random generator; the same seed gives the same run
+start_date = '2010-03-01' # the virtual clock starts at midnight of this day, local time
+output_file = '' # save the results here
+compare_file = '' # compare the results to the ones saved here
+label = '' # name of this run in the saved results
+verbose = False # let gcalert print its messages
+bench = '' # run this benchmark instead of the simulation
+check = False # run the checks instead of the simulation
+
+# -------------------------------------------------------------------------------------------
+
+def iso_time(t):
+    """Unix time 't' the way the calendar feed has it"""
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(t))
+
+def percentile(values, p):
+    """The p-th percentile of 'values', 0 if there are none"""
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+class VirtualClock(object):
+    """Stands in for gcalert.Clock; time only passes when the simulation says so"""
+    def __init__(self, now):
+        self.now = now
+        self.idle = None # called like select() when nothing is readable yet, instead of waiting
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def select(self, fds, seconds):
+        ready = select.select(fds, [], [], 0)[0]
+        if ready or self.idle is None:
+            return ready
+        return self.idle(fds, seconds)
+
+class Thing(object):
+    """Plain object with the given attributes, like the gdata classes"""
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+class FakeFeed(Thing):
+    """A page of a feed"""
+    def GetNextLink(self):
+        return getattr(self, 'next_link', None)
+
+class FakeRequestError(Exception):
+    """Like gdata.service.RequestError; args[0] is a dict with the HTTP status and reason"""
+
+class FakeCalendarService(object):
+    """
+    Serves synthetic calendars the way gdata.calendar.service.CalendarService does:
+    every event recurs daily, and the feed has one 'when' for each occurence
+    in the queried date range; queries with updated-min get the changed and
+    (with showdeleted) the deleted events only, paged by max-results.
+
+    Requests for events take fetch_delay seconds, and those for the first
+    failing_calendars calendars fail as if Google was unavailable.
+    """
+    def __init__(self, rng, clock, email):
+        self.rng = rng
+        self.clock = clock
+        self.email = email
+        self.password = ''
+        self.calendars = {} # calendar id -> {event id -> event dict}
+        self.calendar_names = {} # calendar id -> its name
+        self.pages = {} # next link -> entries still to be served
+        self.lock = thread.allocate_lock() # hold to access pages{} and the counters; queries come from several fetch_workers
+        self.next_id = 0
+        self.requests = 0
+        self.entries_served = 0
+        self.whens_served = 0 # occurences of events in the entries, which make most of the download
+        self.failing = set() # calendars whose events can't be had
+        self.failures = 0 # requests that failed on purpose
+        self.description_size = 0 # bytes of description in each entry, which gdata would parse and keep
+        for c in range(num_calendars):
+            calendar = '%s.sim%d@group.calendar.google.com' % (email, c)
+            self.calendars[calendar] = {}
+            if c < failing_calendars:
+                self.failing.add(calendar)
+            self.calendar_names[calendar] = 'Calendar %d' % c
+            for e in range(num_events):
+                self.add_event(calendar)
+
+    def add_event(self, calendar):
+        """Make up a new recurring event in 'calendar'"""
+        self.next_id += 1
+        event_id = 'http://www.google.com/calendar/feeds/%s/private/full/ev%d' % (urllib.quote(calendar), self.next_id)
+        self.calendars[calendar][event_id] = {
+            'title': 'Event %d' % self.next_id,
+            'where': self.rng.choice(['', 'Room %d' % self.rng.randint(1, 20)]),
+            'minute': self.rng.randint(7*60, 19*60), # of the day, local time
+            'duration': self.rng.choice([15, 30, 60]),
+            'since': self.clock.time() - 86400 * self.rng.randint(0, 365), # the first occurence
+            'reminders': self.random_reminders(),
+            'updated': iso_time(self.clock.time()),
+            'deleted': False,
+        }
+
+    def random_reminders(self):
+        return [ (self.rng.choice(['alert', 'alert', 'email']), str(self.rng.choice([0, 1, 5, 10, 15, 30, 60])))
+            for r in range(self.rng.randint(0, max_reminders)) ]
+
+    def edit(self):
+        """Edit, add or delete one random event"""
+        calendar = self.rng.choice(sorted(self.calendars))
+        events = self.calendars[calendar]
+        live = sorted([ i for i in events if not events[i]['deleted'] ])
+        what = self.rng.random()
+        if what < 0.2 or not live:
+            self.add_event(calendar)
+            return
+        event = events[self.rng.choice(live)]
+        if what < 0.3:
+            event['deleted'] = True
+        elif what < 0.6:
+            event['minute'] = self.rng.randint(7*60, 19*60)
+        elif what < 0.8:
+            event['reminders'] = self.random_reminders()
+        else:
+            event['title'] += "'"
+        event['updated'] = iso_time(self.clock.time())
+
+    def ProgrammaticLogin(self):
+        self.requests += 1
+
+    def GetAllCalendarsFeed(self):
+        self.requests += 1
+        return FakeFeed(entry=[ Thing(id=Thing(text='http://www.google.com/calendar/feeds/default/allcalendars/full/%s' % urllib.quote(c)),
+            title=Thing(text=self.calendar_names[c])) for c in sorted(self.calendars) ])
+
+    def entry(self, event_id, event, days, rules=False):
+        """
+        Feed entry of an event, with its occurences on 'days' (time.struct_time dates),
+        or with its recurrence rules if 'rules' is set
+        """
+        if event['deleted']:
+            return Thing(id=Thing(text=event_id), title=Thing(text=event['title']), where=[], when=[],
+                event_status=Thing(value='http://schemas.google.com/g/2005#event.canceled'))
+        if rules:
+            start = time.localtime(event['since'])[:3] + (event['minute'] // 60, event['minute'] % 60, 0)
+            end = time.localtime(time.mktime(start + (0, 0, -1)) + 60*event['duration'])[:6]
+            return Thing(id=Thing(text=event_id), title=Thing(text=event['title']),
+                where=[Thing(value_string=event['where'])], when=[],
+                recurrence=Thing(text='DTSTART:%04d%02d%02dT%02d%02d%02d\r\nDTEND:%04d%02d%02dT%02d%02d%02d\r\nRRULE:FREQ=DAILY\r\n' % (start + end)),
+                reminder=[ Thing(method=m, minutes=n) for (m, n) in event['reminders'] ],
+                event_status=Thing(value='http://schemas.google.com/g/2005#event.confirmed'))
+        content = Thing(text=('%s ' % event_id).ljust(self.description_size, '.'))
+        when = []
+        for day in days:
+            start = time.mktime(day[:3] + (event['minute'] // 60, event['minute'] % 60, 0, 0, 0, -1))
+            when.append(Thing(start_time=iso_time(start), end_time=iso_time(start + 60*event['duration']),
+                reminder=[ Thing(method=m, minutes=n) for (m, n) in event['reminders'] ]))
+        return Thing(id=Thing(text=event_id), title=Thing(text=event['title']),
+            where=[Thing(value_string=event['where'])], when=when, content=content,
+            event_status=Thing(value='http://schemas.google.com/g/2005#event.confirmed'))
+
+    def CalendarQuery(self, query):
+        """The first page of the events feed for a CalendarEventQuery; like gdata, nothing else is taken"""
+        # http://www.google.com/calendar/feeds/<calendar>/private/full
+        calendar = urllib.unquote(query.feed.split('/feeds/', 1)[1].split('/')[0])
+        time.sleep(fetch_delay)
+        if calendar in self.failing:
+            self.lock.acquire()
+            self.requests += 1
+            self.failures += 1
+            self.lock.release()
+            # what gdata's RequestError has
+            raise FakeRequestError({'status': 503, 'reason': 'Service Unavailable', 'body': ''})
+        first = time.mktime(time.strptime(query['start-min'], '%Y-%m-%d'))
+        last = time.mktime(time.strptime(query['start-max'], '%Y-%m-%d'))
+        days = [ time.localtime(first + 86400*d + 43200) for d in range(int(round((last - first) / 86400))) ]
+        updated_min = query.get('updated-min')
+        show_deleted = query.get('showdeleted') == 'true'
+        # an empty expansion range: recurring events come as their rules
+        rules = query.get('recurrence-expansion-start') is not None and query.get('recurrence-expansion-start') == query.get('recurrence-expansion-end')
+        events = [ (i, e) for (i, e) in sorted(self.calendars[calendar].items())
+            if (not updated_min or e['updated'] >= updated_min) and (show_deleted or not e['deleted']) ]
+        return self.page(events, int(query.get('max-results') or 25), days, rules)
+
+    def GetCalendarEventFeed(self, uri):
+        """The next page of a feed, by the href of its next link"""
+        time.sleep(fetch_delay)
+        self.lock.acquire()
+        args = self.pages.pop(uri)
+        self.lock.release()
+        return self.page(*args)
+
+    def page(self, events, page_size, days, rules):
+        """
+        A feed of the entries of the first 'page_size' of 'events' (list of (event id, event)),
+        linking to the rest; the entries are made only now, like a page is parsed only when downloaded
+        """
+        feed = FakeFeed(entry=[ self.entry(i, e, days, rules) for (i, e) in events[:page_size] ],
+            updated=Thing(text=iso_time(self.clock.time())))
+        self.lock.acquire()
+        self.requests += 1
+        if len(events) > page_size:
+            feed.next_link = Thing(href='http://www.google.com/calendar/feeds/next/%d' % self.requests)
+            self.pages[feed.next_link.href] = (events[page_size:], page_size, days, rules)
+        self.entries_served += len(feed.entry)
+        self.whens_served += sum([ len(e.when) for e in feed.entry ])
+        self.lock.release()
+        return feed
+
+# -------------------------------------------------------------------------------------------
+
+def counter_total(name):
+    """Sum of a gcalert counter over all its labels"""
+    return sum([ v for ((n, labels), v) in gcalert.metrics.values.items() if n == name ])
+
+def lock_stats(name):
+    """(count, mean seconds, total seconds) of a gcalert_lock_*_seconds histogram of events_lock"""
+    h = gcalert.metrics.histograms.get((name, (('lock', 'events_lock'),)))
+    if not h:
+        return (0, 0, 0)
+    count = sum(h[:-1])
+    return (count, h[-1] / count, h[-1])
+
+class SimEventLoop(gcalert.EventLoop):
+    """
+    gcalert's EventLoop on the virtual clock: while nothing is under way on the
+    fetch_workers, waiting makes the time pass at once, with the events edited
+    on the way; at the end, a SIGTERM is sent to stop it
+
+    Finishing a sync takes finish_seconds of virtual time, as saving the cache
+    does, so that other accounts can fall due meanwhile; the loop must then not
+    wait without a timeout (counted in stalls).
+    """
+    finish_seconds = 5
+    def __init__(self, clock, services, end, edit_sleeptime, alarmed):
+        gcalert.EventLoop.__init__(self)
+        self.clock = clock
+        self.services = services
+        self.end = end
+        self.edit_sleeptime = edit_sleeptime
+        self.next_edit = edit_sleeptime and clock.now + edit_sleeptime or end
+        self.alarmed = alarmed # called with the alarms that went off by now
+        self.started = {} # account -> real time its sync started
+        self.sync_wall = []
+        self.syncs = 0
+        self.failed_syncs = 0
+        self.stalls = 0
+        self.terminated = False
+        clock.idle = self.idle
+
+    def start_sync(self, account):
+        self.started[account] = time.time()
+        gcalert.EventLoop.start_sync(self, account)
+
+    def sync_done(self, account, sleeptime):
+        gcalert.EventLoop.sync_done(self, account, sleeptime)
+        self.clock.now += self.finish_seconds
+        self.sync_wall.append(time.time() - self.started.pop(account))
+        self.syncs += 1
+        if not account.connected:
+            self.failed_syncs += 1
+
+    def idle(self, fds, seconds):
+        if seconds is None and [ a for a in gcalert.accounts if a not in self.syncing ]:
+            # an account is to be synced at some point, but nothing would wake the loop for it
+            self.stalls += 1
+        if self.syncing:
+            # the fetch_workers are at it, in real time
+            return select.select(fds, [], [], None)[0]
+        self.alarmed()
+        if self.clock.now >= self.end:
+            if not self.terminated:
+                self.terminated = True
+                os.kill(os.getpid(), signal.SIGTERM)
+            return select.select(fds, [], [], 0)[0]
+        due = [ self.end, self.next_edit ]
+        if seconds is not None:
+            due.append(self.clock.now + seconds)
+        self.clock.now = max(self.clock.now, min(due))
+        if self.edit_sleeptime and self.next_edit <= self.clock.now:
+            for s in self.services:
+                s.edit()
+            self.next_edit += self.edit_sleeptime
+        return []
+
+def cache_mismatches():
+    """
+    Save the cache and load it into new Accounts, as a restart would
+    returns: number of coming events and alarms that are not the same after it
+    """
+    def upcoming(account):
+        now = gcalert.clock.time()
+        return (set([ k for (k, entry) in account.events.items() if entry[2].starttime_unix > now ]),
+            set([ k for (k, e) in account.alarmed_events.items() if e.starttime_unix > now ]))
+    before = [ upcoming(a) for a in gcalert.accounts ]
+    gcalert.save_cache()
+    gcalert.accounts[:] = [ gcalert.Account(a.name, calendarservice=a.calendarservice) for a in gcalert.accounts ]
+    del gcalert.alarm_queue[:]
+    gcalert.pending_alarms.clear()
+    del gcalert.pending_expiry[:]
+    gcalert.load_cache()
+    after = [ upcoming(a) for a in gcalert.accounts ]
+    return sum([ len(b[0] ^ a[0]) + len(b[1] ^ a[1]) for (b, a) in zip(before, after) ])
+
+def simulate():
+    """
+    Run the simulation; returns the results as a dict
+
+    Alarm lateness includes alarms that were already due when gcalert learned
+    about them (e.g. a reminder added 5 minutes before the event), not only
+    those that were found in time but went off late.
+    """
+    rng = random.Random(seed)
+    random.seed(seed) # for the jitter of gcalert's sleep times
+    clock = VirtualClock(time.mktime(time.strptime(start_date, '%Y-%m-%d')))
+    gcalert.clock = clock
+    gcalert.cache_file = ''
+    gcalert.quiet_flag = not verbose
+    services = [ FakeCalendarService(rng, clock, 'user%d@example.com' % a) for a in range(num_accounts) ]
+    gcalert.accounts[:] = [ gcalert.Account(s.email, calendarservice=s) for s in services ]
+    # nobody reads it in the simulation; a full pipe must not block
+    fcntl.fcntl(gcalert.wakeup_pipe[1], fcntl.F_SETFL, fcntl.fcntl(gcalert.wakeup_pipe[1], fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    end = clock.now + sim_days * 86400
+    edit_sleeptime = edits_per_hour and 3600.0 / edits_per_hour or None
+    next_edit = edit_sleeptime and clock.now + edit_sleeptime or end
+    (syncs, failed_syncs) = (0, 0)
+    sync_cpu = [] # seconds for each sync
+    sync_wall = [] # real seconds for each sync, waiting for the fake Google included
+    lateness = [] # seconds for each alarm
+    notifications = [] # number of alarms in each
+    def alarmed():
+        while 1:
+            try:
+                (batch, alarm_ids) = gcalert.notification_queue.get_nowait()
+            except Queue.Empty:
+                break
+            notifications.append(len(batch))
+            for e in batch:
+                lateness.append(clock.now - e.alarm_time_unix)
+    (mismatches, stalls) = (0, 0)
+    if gcalert.engine == 'loop':
+        # what gcalert.py does with --engine=loop, with a cache
+        (fd, gcalert.cache_file) = tempfile.mkstemp(prefix='gcalert_sim')
+        os.close(fd)
+        signal.signal(signal.SIGTERM, gcalert.stopthismadness)
+        loop = SimEventLoop(clock, services, end, edit_sleeptime, alarmed)
+        loop.run()
+        alarmed()
+        (syncs, failed_syncs, sync_wall, stalls) = (loop.syncs, loop.failed_syncs, loop.sync_wall, loop.stalls)
+        # the cache saved on the way out has to have it all
+        mismatches = cache_mismatches()
+        os.unlink(gcalert.cache_file)
+        gcalert.cache_file = ''
+    while clock.now < end and gcalert.engine != 'loop':
+        # jump to whatever comes next
+        due = [ end, next_edit ] + [ a.next_sync for a in gcalert.accounts ]
+        if gcalert.alarm_queue:
+            due.append(gcalert.alarm_queue[0][0])
+        clock.now = max(clock.now, min(due))
+        if edit_sleeptime and next_edit <= clock.now:
+            for s in services:
+                s.edit()
+            next_edit += edit_sleeptime
+        for account in gcalert.accounts:
+            if account.next_sync <= clock.now:
+                (cpu, wall) = (time.clock(), time.time())
+                account.next_sync = clock.now + gcalert.sync_account(account)
+                sync_cpu.append(time.clock() - cpu)
+                sync_wall.append(time.time() - wall)
+                syncs += 1
+                if not account.connected:
+                    failed_syncs += 1
+        gcalert.fire_due_alarms()
+        alarmed()
+
+    (lock_count, lock_wait, lock_wait_total) = lock_stats('gcalert_lock_wait_seconds')
+    (lock_count, lock_hold, lock_hold_total) = lock_stats('gcalert_lock_hold_seconds')
+    results = {
+        'label': label,
+        'settings': settings(),
+        'syncs': syncs,
+        'sync_failures': failed_syncs, # of whole accounts
+        'calendar_failures': counter_total('gcalert_calendar_sync_failures_total'), # skipped calendars
+        'failures_injected': sum([ s.failures for s in services ]),
+        'requests': sum([ s.requests for s in services ]),
+        'entries_served': sum([ s.entries_served for s in services ]),
+        'whens_served': sum([ s.whens_served for s in services ]),
+        'alarms': len(lateness),
+        'notifications': len(notifications),
+        'sync_wall_mean': sync_wall and sum(sync_wall) / len(sync_wall) or 0,
+        'sync_wall_p95': percentile(sync_wall, 95),
+        'peak_memory_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'lock_acquisitions': lock_count,
+        'lock_wait_mean': lock_wait,
+        'lock_hold_mean': lock_hold,
+        'lock_hold_total': lock_hold_total,
+        'lateness_p50': percentile(lateness, 50),
+        'lateness_p90': percentile(lateness, 90),
+        'lateness_p99': percentile(lateness, 99),
+        'lateness_max': lateness and max(lateness) or 0,
+    }
+    if gcalert.engine == 'loop':
+        results['cache_mismatches'] = mismatches
+        results['loop_stalls'] = stalls
+    else:
+        # the fetch_workers of the EventLoop can't be timed on their own; python 2 has only process CPU time
+        results['sync_cpu_total'] = sum(sync_cpu)
+        results['sync_cpu_mean'] = sync_cpu and sum(sync_cpu) / len(sync_cpu) or 0
+        results['sync_cpu_p95'] = percentile(sync_cpu, 95)
+    return results
+
+def settings():
+    """The parameters of the run, to go with its results"""
+    return { 'accounts': num_accounts, 'calendars': num_calendars, 'events': num_events,
+        'max_reminders': max_reminders, 'days': sim_days, 'edits_per_hour': edits_per_hour, 'seed': seed,
+        'start': start_date, 'fetch_delay': fetch_delay, 'failing_calendars': failing_calendars,
+        'look': gcalert.lookahead_days, 'engine': gcalert.engine }
+
+def bench_time(function, count, repeat=3):
+    """CPU microseconds per item of function(), which does 'count' items; the best of 'repeat' runs"""
+    best = None
+    for r in range(repeat):
+        cpu = time.clock()
+        function()
+        cpu = time.clock() - cpu
+        if best is None or cpu < best:
+            best = cpu
+    return 1e6 * best / count
+
+def bench_events():
+    """
+    Per-event cost of GcEvent: making one, comparing two equal ones, checking whether
+    its alarm is due (as fire_due_alarms() does) and formatting it, for -c x -e events
+    """
+    clock = VirtualClock(time.mktime(time.strptime(start_date, '%Y-%m-%d')))
+    count = num_calendars * num_events
+    times = [ (iso_time(clock.now + 60*i), iso_time(clock.now + 60*i + 1800)) for i in range(count) ]
+    def make():
+        gcalert.parsed_times.clear() # as every sync does
+        return [ gcalert.GcEvent('calendar', 'event%d' % i, 'Event %d' % i, 'Room 1', start, end, '10')
+            for (i, (start, end)) in enumerate(times) ]
+    (events, copies) = (make(), make())
+    pairs = zip(events, copies)
+    now = clock.now + 30 * count
+    def compare():
+        for (e, f) in pairs:
+            e == f
+    def check():
+        for e in events:
+            e.alarm_time_unix <= now and e.starttime_unix < now
+    results = {
+        'label': label,
+        'settings': settings(),
+        'event_make_us': bench_time(make, count),
+        'event_compare_us': bench_time(compare, count),
+        'event_alarm_check_us': bench_time(check, count),
+    }
+    # only the first str() formats the times
+    results['event_str_us'] = bench_time(lambda: [ str(e) for e in make() ], count) - results['event_make_us']
+    return results
+
+def bench_parse():
+    """
+    Parsing a synthetic feed of -c x -e recurring events with --look days of occurences:
+    the feed's timestamps one by one with the fast path and with dateutil, and all
+    entries into GcEvents with entry_events(), as a sync does
+    """
+    clock = VirtualClock(time.mktime(time.strptime(start_date, '%Y-%m-%d')))
+    service = FakeCalendarService(random.Random(seed), clock, 'user@example.com')
+    days = [ time.localtime(clock.now + 86400*d + 43200) for d in range(gcalert.lookahead_days) ]
+    entries = [ service.entry(i, e, days) for c in sorted(service.calendars) for (i, e) in sorted(service.calendars[c].items()) ]
+    timestamps = [ t for e in entries for w in e.when for t in (w.start_time, w.end_time) ]
+    def fast():
+        for t in timestamps:
+            gcalert.parsed_times.clear()
+            gcalert.parse_unix_time(t)
+    def slow():
+        for t in timestamps:
+            gcalert.unix_time(gcalert.parse_time(t))
+    def parse():
+        gcalert.parsed_times.clear()
+        for e in entries:
+            gcalert.entry_events('calendar', e)
+    gcalert.parsed_times.clear()
+    return {
+        'label': label,
+        'settings': settings(),
+        'occurences': len(timestamps) / 2,
+        'gcevents': sum([ len(gcalert.entry_events('calendar', e)) for e in entries ]),
+        'parse_fast_us': bench_time(fast, len(timestamps)),
+        'parse_dateutil_us': bench_time(slow, len(timestamps), 1),
+        'feed_parse_cpu': bench_time(parse, 1e6),
+    }
+
+def bench_feed():
+    """
+    Peak memory of a full sync of -c calendars of -e events each, whose feeds come in
+    pages of feed_page_size entries with a 2 kB description each, and a popup reminder
+    in one entry of ten: first page by page as CalendarState.sync() does, then all
+    pages downloaded before any is parsed, as before it did
+    """
+    clock = VirtualClock(time.mktime(time.strptime(start_date, '%Y-%m-%d')))
+    service = FakeCalendarService(random.Random(seed), clock, 'user@example.com')
+    service.description_size = 2048
+    for c in service.calendars.itervalues():
+        for (n, i) in enumerate(sorted(c)):
+            c[i]['reminders'] = [ (n % 10 and 'email' or 'alert', '10') ]
+    gcalert.clock = clock
+    (range_start, range_end) = gcalert.query_range()
+    def peak():
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results = { 'label': label, 'settings': settings(), 'memory_start_kb': peak() }
+    cpu = time.clock()
+    gcevents = 0
+    for calendar in sorted(service.calendars):
+        state = gcalert.CalendarState()
+        state.sync(service, calendar, range_start, range_end, True, clock.now)
+        gcevents += sum([ len(o) for o in state.events.itervalues() ])
+        state = None
+    results['streamed_cpu'] = time.clock() - cpu
+    results['streamed_peak_kb'] = peak()
+    results['gcevents'] = gcevents
+    results['pages'] = service.requests
+    cpu = time.clock()
+    pages = []
+    for calendar in sorted(service.calendars):
+        pages += list(gcalert.feed_pages(service, gcalert.calendar_query(calendar, range_start, range_end)))
+    events = [ e for page in pages for entry in page.entry for e in gcalert.entry_events('calendar', entry) ]
+    results['whole_cpu'] = time.clock() - cpu
+    # only grows, so this is after the streamed sync
+    results['whole_peak_kb'] = peak()
+    return results
+
+# name -> (function returning the results, what it measures)
+benchmarks = {
+    'events': (bench_events, 'per-event cost of GcEvent'),
+    'parse': (bench_parse, 'timestamp and feed parsing, with -l days'),
+    'feed': (bench_feed, 'peak memory of syncing big paged feeds'),
+}
+
+def utc(s):
+    """Unix time of 'YYYYmmddTHHMMSS' in UTC"""
+    return timegm(time.strptime(s, '%Y%m%dT%H%M%S'))
+
+def check_recurrence():
+    """
+    Recurring events as expanded with --local-recurrence: across the spring DST
+    change in the event's own time zone, with EXDATE and a date-only UNTIL, with
+    modified occurences, and keyed the same as when Google expands them
+    returns: list of (what was checked, what came out, what should have)
+    """
+    import dateutil.tz
+    results = []
+    # Budapest goes from +01:00 to +02:00 on 2010-03-28
+    (rules, duration, all_day) = gcalert.parse_recurrence(
+        'DTSTART;TZID=Europe/Budapest:20100326T090000\r\nDTEND;TZID=Europe/Budapest:20100326T093000\r\n'
+        'RRULE:FREQ=DAILY;COUNT=4\r\nBEGIN:VTIMEZONE\r\nTZID:Europe/Budapest\r\nEND:VTIMEZONE\r\n')
+    results.append(('daily at 9:00 in Budapest, across the DST change', [ gcalert.unix_time(t) for t in rules ],
+        [ utc('20100326T080000'), utc('20100327T080000'), utc('20100328T070000'), utc('20100329T070000') ]))
+    results.append(('duration from DTEND', (duration, all_day), (datetime.timedelta(minutes=30), False)))
+    (rules, duration, all_day) = gcalert.parse_recurrence(
+        'DTSTART;TZID=Europe/Budapest:20100326T090000\r\nDURATION:PT1H\r\n'
+        'RRULE:FREQ=DAILY;UNTIL=20100328\r\nEXDATE;TZID=Europe/Budapest:20100327T090000\r\n')
+    results.append(('EXDATE, and UNTIL a date including that day', [ gcalert.unix_time(t) for t in rules ],
+        [ utc('20100326T080000'), utc('20100328T070000') ]))
+    (rules, duration, all_day) = gcalert.parse_recurrence('DTSTART;VALUE=DATE:20100326\r\nRRULE:FREQ=WEEKLY;COUNT=2\r\n')
+    results.append(('all-day, weekly', ([ t.strftime('%Y-%m-%d') for t in rules ], duration, all_day),
+        (['2010-03-26', '2010-04-02'], datetime.timedelta(days=1), True)))
+
+    calendar = 'cal@example.com'
+    feed = 'http://www.google.com/calendar/feeds/%s/private/full' % urllib.quote(calendar)
+    series = gcalert.RecurringEvent(calendar, feed + '/abc', 'Standup', '',
+        'DTSTART;TZID=Europe/Budapest:20100326T090000\r\nDTEND;TZID=Europe/Budapest:20100326T093000\r\nRRULE:FREQ=DAILY\r\n', ['10', '0'])
+    # the occurence on Saturday moved to 11:00, as Google has it
+    moved = Thing(id=Thing(text=feed + '/abc_20100327T080000Z'),
+        original_event=Thing(id='abc', when=Thing(start_time='2010-03-27T09:00:00.000+01:00')))
+    exception = gcalert.exception_of(moved)
+    results.append(('exception_of() a moved occurence', exception, (feed + '/abc', utc('20100327T080000'))))
+    results.append(('exception_of() an event that is none', gcalert.exception_of(Thing(id=Thing(text=feed + '/def'))), None))
+    occurences = series.occurences(utc('20100326T000000'), utc('20100329T000000'), set([exception[1]]))
+    results.append(('occurences() without the moved one', sorted([ (e.starttime_unix, int(e.minutes)) for e in occurences ]),
+        [ (utc('20100326T080000'), 0), (utc('20100326T080000'), 10), (utc('20100328T070000'), 0), (utc('20100328T070000'), 10) ]))
+    results.append(('occurences() end at DTEND', sorted(set([ e.endtime_unix for e in occurences ])),
+        [ utc('20100326T083000'), utc('20100328T073000') ]))
+    # Google writes the times with the calendar's offset, RecurringEvent in UTC
+    google = gcalert.GcEvent(calendar, feed + '/abc', 'Standup', '', '2010-03-28T09:00:00.000+02:00', '2010-03-28T09:30:00.000+02:00', '10')
+    results.append(('the same alarm from Google and from occurences()', google in occurences, True))
+    later = series.occurences(utc('20100328T000000'), utc('20100329T000000'))
+    results.append(('occurences() further on, from what was worked out before', sorted(set([ e.starttime_unix for e in later ])),
+        [ utc('20100328T070000') ]))
+    return results
+
+class FeedService(object):
+    """Serves the given feeds, one for each query, like CalendarService does"""
+    def __init__(self, feeds):
+        self.feeds = feeds
+
+    def CalendarQuery(self, query):
+        return self.feeds.pop(0)
+
+def check_exceptions():
+    """
+    Occurences of a recurring event as Google expands them, moved or cancelled later
+    and synced as changes only: the original occurence must not be alarmed
+    returns: list of (what was checked, what came out, what should have)
+    """
+    feed = 'http://www.google.com/calendar/feeds/cal%40example.com/private/full'
+    def when(start):
+        return Thing(start_time=start + ':00.000Z', end_time=start[:-5] + '%02d:30:00.000Z' % int(start[-5:-3]),
+            reminder=[Thing(method='alert', minutes='10')])
+    def entry(event_id, whens, original=None, status='confirmed'):
+        e = Thing(id=Thing(text=feed + '/' + event_id), title=Thing(text='Standup'), where=[], when=whens,
+            event_status=Thing(value='http://schemas.google.com/g/2005#event.' + status))
+        if original:
+            e.original_event = Thing(id='abc', when=Thing(start_time=original + ':00.000Z'))
+        return e
+    def starts(state):
+        return sorted([ (event_id.rsplit('/', 1)[1], time.strftime('%d %H:%M', time.gmtime(e.starttime_unix)))
+            for (event_id, occurences) in state.events.items() for e in occurences ])
+    def page(*entries):
+        return FakeFeed(entry=list(entries), updated=Thing(text='2010-03-25T00:00:00.000Z'))
+    results = []
+    state = gcalert.CalendarState()
+    service = FeedService([
+        page(entry('abc', [when('2010-03-26T09:00'), when('2010-03-27T09:00'), when('2010-03-28T09:00')])),
+        page(entry('abc_20100326T090000Z', [when('2010-03-26T11:00')], '2010-03-26T09:00')),
+        page(entry('abc_20100327T090000Z', [], '2010-03-27T09:00', 'canceled')),
+        # the exception may come before the recurring event
+        page(entry('abc_20100326T090000Z', [when('2010-03-26T11:00')], '2010-03-26T09:00'),
+            entry('abc', [when('2010-03-26T09:00'), when('2010-03-27T09:00'), when('2010-03-28T09:00')])),
+    ])
+    state.sync(service, 'cal@example.com', '2010-03-25', '2010-03-30', True, 0)
+    state.sync(service, 'cal@example.com', '2010-03-25', '2010-03-30', False, 0)
+    results.append(('a moved occurence, synced as a change', starts(state),
+        [ ('abc', '27 09:00'), ('abc', '28 09:00'), ('abc_20100326T090000Z', '26 11:00') ]))
+    state.sync(service, 'cal@example.com', '2010-03-25', '2010-03-30', False, 0)
+    results.append(('a cancelled occurence, synced as a change', starts(state),
+        [ ('abc', '28 09:00'), ('abc_20100326T090000Z', '26 11:00') ]))
+    state = gcalert.CalendarState()
+    state.sync(service, 'cal@example.com', '2010-03-25', '2010-03-30', True, 0)
+    results.append(('a moved occurence, before its recurring event', starts(state),
+        [ ('abc', '27 09:00'), ('abc', '28 09:00'), ('abc_20100326T090000Z', '26 11:00') ]))
+    return results
+
+# functions returning lists of (what was checked, what came out, what should have)
+checks = [ check_recurrence, check_exceptions ]
+
+def run_checks():
+    """Run the checks and print how they went; returns the number that failed"""
+    failed = 0
+    for function in checks:
+        for (what, got, wanted) in function():
+            if got == wanted:
+                print "ok      %s" % what
+            else:
+                failed += 1
+                print "FAILED  %s: got %r, should be %r" % (what, got, wanted)
+    return failed
+
+def report(results, previous=None):
+    """Print the results, next to the previous ones if given"""
+    print "gcalert %s: %s" % (bench and 'benchmark ' + bench or 'simulation', ' '.join([ '%s=%s' % kv for kv in sorted(results['settings'].items()) ]))
+    if previous:
+        print "%-20s %16s %16s" % ('', previous['label'] or 'previous', results['label'] or 'this run')
+    def value(r, key):
+        # not measured in that run, e.g. with another --engine
+        return key in r and '%16.6g' % r[key] or '%16s' % '-'
+    for key in sorted(set(results) | set(previous or {})):
+        if key in ('label', 'settings'):
+            continue
+        if previous:
+            print "%-20s %s %s" % (key, value(previous, key), value(results, key))
+        else:
+            print "%-20s %s" % (key, value(results, key))
+
+def usage():
+    """Print usage information."""
+    print "Run gcalert against synthetic calendars on a virtual clock and report how it did."
+    print "Usage: gcalert_sim.py [options]"
+    print " -a N, --accounts=N   : simulate N accounts (default: %d)" % num_accounts
+    print " -c N, --calendars=N  : N calendars per account (default: %d)" % num_calendars
+    print " -e N, --events=N     : N daily recurring events per calendar"
+    print "                        (default: %d)" % num_events
+    print " -r N, --reminders=N  : at most N reminders per event (default: %d)" % max_reminders
+    print " -d N, --days=N       : simulate N days (default: %d)" % sim_days
+    print " -x N, --edits=N      : edit N events per hour per account"
+    print "                        (default: %d)" % edits_per_hour
+    print " --fetch-delay=S      : each request for events takes S seconds"
+    print "                        (real time, fractions allowed; default: %g)" % fetch_delay
+    print " --failing=N          : requests for the events of N calendars of"
+    print "                        each account fail; they should be skipped"
+    print "                        (default: %d)" % failing_calendars
+    print " --seed=N             : random seed (default: %d)" % seed
+    print " --start=YYYY-MM-DD   : start the virtual clock on this day"
+    print "                        (default: %s)" % start_date
+    print " --label=L            : name this run in the results"
+    print " -o F, --output=F     : save the results to file F"
+    print " --compare=F          : compare to results saved in file F"
+    print " -v, --verbose        : show gcalert's messages"
+    print " --bench=B            : run benchmark B over the -c x -e synthetic"
+    print "                        events instead of the simulation; B is one of:"
+    for name in sorted(benchmarks):
+        print "                        %-8s %s" % (name, benchmarks[name][1])
+    print " --check              : check recurrence expansion (DST, EXDATE,"
+    print "                        UNTIL, modified occurences) and syncing"
+    print "                        moved and cancelled occurences instead"
+    print "All other options are passed on to gcalert (see gcalert.py -h),"
+    print "e.g. --engine=E, --look=N, --query=N, --query-min=N, --full-sync=N, --coalesce=N,"
+    print "--include=C, --exclude=C, --title=R, --skip-title=R, --local-recurrence,"
+    print "--horizon=S"
+
+if __name__ == '__main__':
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hva:c:e:r:d:x:o:l:q:", ["help", "verbose", "accounts=", "calendars=", "events=", "reminders=", "days=", "edits=", "fetch-delay=", "failing=", "seed=", "start=", "label=", "output=", "compare=", "bench=", "check",
+            "look=", "query=", "query-min=", "full-sync=", "coalesce=", "fetch-workers=", "engine=",
+            "include=", "exclude=", "title=", "skip-title=", "local-recurrence", "horizon="])
+    except getopt.GetoptError as err:
+        print str(err)
+        sys.exit(2)
+
+    title_includes = []
+    title_excludes = []
+    try:
+        for o, a in opts:
+            if o in ("-h", "--help"):
+                usage()
+                sys.exit()
+            elif o in ("-v", "--verbose"):
+                verbose = True
+            elif o in ("-a", "--accounts"):
+                num_accounts = int(a)
+            elif o in ("-c", "--calendars"):
+                num_calendars = int(a)
+            elif o in ("-e", "--events"):
+                num_events = int(a)
+            elif o in ("-r", "--reminders"):
+                max_reminders = int(a)
+            elif o in ("-d", "--days"):
+                sim_days = int(a)
+            elif o in ("-x", "--edits"):
+                edits_per_hour = int(a)
+            elif o == "--fetch-delay":
+                fetch_delay = float(a)
+            elif o == "--failing":
+                failing_calendars = int(a)
+            elif o == "--seed":
+                seed = int(a)
+            elif o == "--start":
+                try:
+                    time.strptime(a, '%Y-%m-%d')
+                except ValueError:
+                    print "Option --start requires a date like %s; use '-h' for help." % start_date
+                    sys.exit(1)
+                start_date = a
+            elif o == "--label":
+                label = a
+            elif o in ("-o", "--output"):
+                output_file = a
+            elif o == "--compare":
+                compare_file = a
+            elif o == "--check":
+                check = True
+            elif o == "--bench":
+                if a not in benchmarks:
+                    print "Unknown benchmark %s; use '-h' for help." % a
+                    sys.exit(2)
+                bench = a
+            elif o in ("-l", "--look"):
+                gcalert.lookahead_days = int(a)
+            elif o in ("-q", "--query"):
+                gcalert.query_sleeptime = int(a)
+            elif o == "--query-min":
+                gcalert.query_min_sleeptime = int(a)
+            elif o == "--full-sync":
+                gcalert.full_sync_sleeptime = int(a)
+            elif o == "--coalesce":
+                gcalert.coalesce_sleeptime = int(a)
+            elif o == "--fetch-workers":
+                gcalert.fetch_workers = int(a)
+            elif o == "--engine":
+                if a not in ('threads', 'loop'):
+                    print "Engine should be 'threads' or 'loop'; use '-h' for help."
+                    sys.exit(2)
+                gcalert.engine = a
+            elif o == "--local-recurrence":
+                gcalert.local_recurrence = True
+            elif o == "--horizon":
+                gcalert.recurrence_horizon = int(a)
+            elif o == "--include":
+                gcalert.calendar_includes.append(a.lower())
+            elif o == "--exclude":
+                gcalert.calendar_excludes.append(a.lower())
+            elif o == "--title":
+                title_includes.append(a)
+            elif o == "--skip-title":
+                title_excludes.append(a)
+            else:
+                assert False, "unhandled option"
+    except ValueError:
+        print "Option %s requires an integer parameter; use '-h' for help." % o
+        sys.exit(1)
+
+    if failing_calendars >= num_calendars:
+        print "At least one calendar has to work, or the accounts are offline; use '-h' for help."
+        sys.exit(2)
+
+    try:
+        gcalert.title_include_re = gcalert.title_regex(title_includes)
+        gcalert.title_exclude_re = gcalert.title_regex(title_excludes)
+    except re.error as error:
+        print "Bad title regex (%s)" % error
+        sys.exit(2)
+
+    if check:
+        sys.exit(run_checks() and 1 or 0)
+
+    previous = None
+    if compare_file:
+        try:
+            previous = json.load(open(compare_file))
+        except (IOError, ValueError) as error:
+            print "Could not read results from %s: %s" % (compare_file, error)
+            sys.exit(1)
+
+    results = bench and benchmarks[bench][0]() or simulate()
+    report(results, previous)
+    # the calendars failed on purpose are expected to be skipped, and nothing else
+    failed = results.get('sync_failures', 0) + results.get('cache_mismatches', 0) + results.get('loop_stalls', 0) + abs(results.get('calendar_failures', 0) - results.get('failures_injected', 0))
+    if failed:
+        print "%d syncs failed or were not skipped as they should; run with -v to see why" % failed
+
+    if output_file:
+        f = open(output_file, 'w')
+        json.dump(results, f, indent=1, sort_keys=True)
+        f.close()
+
+    # without waiting for the fetch_worker threads, which never finish
+    sys.stdout.flush()
+    os._exit(failed and 1 or 0)